@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+import numpy as np
+import netCDF4 as nC
+
+import run
+import cities_catalog
+
+# Synthetic granules are made for these products, see run.PRODUCTS
+BENCHMARK_PRODUCTS = ['L2__O3____', 'L1B_RA_BD1']
+
+# Sentinel-5P file name of a synthetic granule, see run.FILENAME_PATTERN
+GRANULE_FILENAME = 'S5P_OFFL_{}_20190101T100000_20190101T114000_06290_01_010105_20190107T112345.nc'
+
+
+def get_swath_geolocation(scanlines, pixels):
+    """
+    Calculates the geolocation of a synthetic descending swath over Europe. Like a TROPOMI orbit the
+    swath runs from pole to pole and is about 2600 km wide, the ground track is slightly tilted.
+
+    :param scanlines: Number of scanlines.
+    :param pixels: Number of ground pixels of a scanline.
+    :return: Tuple of (scanlines, pixels) float32 latitude and longitude arrays.
+    """
+
+    along_track = np.linspace(85.0, -85.0, scanlines)[:, np.newaxis]
+    across_track = np.linspace(-1.0, 1.0, pixels)[np.newaxis, :]
+
+    latitudes = along_track + 1.5 * across_track ** 2
+    # The swath width in degrees of longitude grows towards the poles
+    longitudes = 15.0 + 0.1 * (along_track - 50.0) \
+        + 11.7 * across_track / np.maximum(np.cos(np.radians(along_track)), 0.2)
+
+    return latitudes.astype(np.float32), longitudes.astype(np.float32)
+
+
+def get_footprint(latitudes, longitudes, step=64):
+    """
+    Formats the outline of the swath as a gml:posList attribute, 'lat lon lat lon ...'.
+
+    :param latitudes: 2D array of pixel latitudes.
+    :param longitudes: 2D array of pixel longitudes.
+    :param step: Distance in scanlines between the outline points.
+    :return: str
+    """
+
+    rows = np.append(np.arange(0, latitudes.shape[0], step), latitudes.shape[0] - 1)
+    ring = [(latitudes[row, 0], longitudes[row, 0]) for row in rows] \
+        + [(latitudes[row, -1], longitudes[row, -1]) for row in rows[::-1]]
+    ring.append(ring[0])
+
+    return ' '.join('{:.6f} {:.6f}'.format(latitude, longitude) for latitude, longitude in ring)
+
+
+def create_group(nc_dataset, path):
+    """
+    Returns the group of the given path, creating the missing groups.
+
+    :param nc_dataset: NetCDF dataset.
+    :param path: Group path, e.g. '/PRODUCT'.
+    :return: NetCDF group.
+    """
+
+    group = nc_dataset
+    for name in path.strip('/').split('/'):
+        group = group.groups[name] if name in group.groups else group.createGroup(name)
+    return group
+
+
+def write_granule(filename, file_type, scanlines, pixels, bands, seed=0):
+    """
+    Writes a synthetic granule with the group layout of the Sentinel-5P product, see run.PRODUCTS.
+    The variables are compressed and chunked along the scanlines like the distributed products.
+
+    :param filename: Path to the *.nc file.
+    :param file_type: Key of run.PRODUCTS.
+    :param scanlines: Number of scanlines.
+    :param pixels: Number of ground pixels of a scanline.
+    :param bands: Number of spectral channels of a radiance product.
+    :param seed: Seed of the random values.
+    :return: None
+    """
+
+    product = run.PRODUCTS[file_type]
+    rng = np.random.default_rng(seed)
+    latitudes, longitudes = get_swath_geolocation(scanlines, pixels)
+    chunk_rows = min(scanlines, 128)
+
+    ds = nC.Dataset(filename, 'w')
+    setattr(create_group(ds, run.FOOTPRINT_GROUP), 'gml:posList', get_footprint(latitudes, longitudes))
+
+    obs = create_group(ds, product['group'])
+    geo = create_group(ds, product['geolocation'])
+    for group in {obs.path: obs, geo.path: geo}.values():
+        group.createDimension('time', 1)
+        group.createDimension('scanline', scanlines)
+        group.createDimension('ground_pixel', pixels)
+
+    dimensions = ('time', 'scanline', 'ground_pixel')
+    for name, values in (('latitude', latitudes), ('longitude', longitudes)):
+        geo.createVariable(name, 'f4', dimensions, zlib=True, chunksizes=(1, chunk_rows, pixels))[:] = \
+            values[np.newaxis]
+
+    field = np.sin(np.radians(latitudes) * 4.0) + np.cos(np.radians(longitudes) * 3.0)
+    if product['level'] == 'L1B':
+        obs.createDimension('spectral_channel', bands)
+        variable = obs.createVariable(product['variable'], 'f4', dimensions + ('spectral_channel',), zlib=True,
+                                      chunksizes=(1, chunk_rows, pixels, bands), fill_value=9.96921e36)
+        for row in range(0, scanlines, chunk_rows):
+            rows = slice(row, row + chunk_rows)
+            noise = rng.normal(0.0, 0.01, field[rows].shape + (bands,))
+            variable[0, rows] = field[rows, :, np.newaxis] * np.linspace(1.0, 2.0, bands) + noise
+    else:
+        variable = obs.createVariable(product['variable'], 'f4', dimensions, zlib=True,
+                                      chunksizes=(1, chunk_rows, pixels), fill_value=9.96921e36)
+        values = np.ma.masked_array(field + rng.normal(0.0, 0.01, field.shape),
+                                    mask=rng.random(field.shape) < 0.05)
+        variable[:] = values[np.newaxis]
+
+    ds.close()
+
+
+def measure(function, repeat):
+    """
+    Calls the function repeat times.
+
+    :param function: Function without arguments.
+    :param repeat: Number of calls.
+    :return: List of call durations in seconds.
+    """
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def benchmark_functions(filename, cities_list, output_dir, repeat):
+    """
+    Times the processing functions on the cities covered by a synthetic L2 granule. Every timing
+    covers all cities.
+
+    :param filename: Path to a synthetic L2 granule.
+    :param cities_list: GeoJSON feature collection of the city areas.
+    :param output_dir: Path to a scratch directory for the written files.
+    :param repeat: Number of timed runs.
+    :return: Dictionary of benchmark name -> list of durations.
+    """
+
+    product = run.PRODUCTS[run.parse_filename(filename)['file_type']]
+    cities_index = run.build_cities_index(cities_catalog.create_catalog(cities_list))
+
+    ds = nC.Dataset(filename, 'r')
+    cities_in_file = run.query_cities_index(cities_index, run.get_product_extent(ds))
+    geodata = run.read_variables(ds[product['geolocation']], ['latitude', 'longitude'])
+    lats = geodata['latitude']
+    lons = geodata['longitude']
+    vals = run.read_variables(ds[product['group']], [product['variable']])[product['variable']]
+    ds.close()
+
+    city_windows = run.get_city_windows(run.build_swath_index(lats, lons), cities_index, cities_in_file)
+    print('Cities covered by the swath:', len(city_windows))
+
+    selected = []
+    tiles = []
+    for small_bbox, big_bbox, window in city_windows.values():
+        points = run.select_points(lats, lons, vals, big_bbox, window)
+        if points[2] is not None:
+            selected.append(points)
+            tiles.append((run.regrid(*points, 30)[2], small_bbox))
+
+    def select():
+        for _, big_bbox, window in city_windows.values():
+            run.select_points(lats, lons, vals, big_bbox, window)
+
+    def regrid():
+        for slats, slons, svals in selected:
+            run.regrid(slats, slons, svals, 100)
+
+    def write_geotiff():
+        for i, (svals, bbox) in enumerate(tiles):
+            run.write_geotiff(svals, os.path.join(output_dir, str(i)), bbox)
+
+    def write_png():
+        for i, (svals, _) in enumerate(tiles):
+            run.write_png(svals, os.path.join(output_dir, str(i)))
+
+    timings = {
+        'select_points': measure(select, repeat),
+        'regrid': measure(regrid, repeat),
+        'write_geotiff': measure(write_geotiff, repeat),
+        'write_png': measure(write_png, repeat),
+    }
+    return timings
+
+
+def benchmark_main(input_dir, cities_list, work_dir, repeat, arguments):
+    """
+    Times end-to-end runs of run.py on the synthetic granules. run.py reads cities_areas.json from the
+    working directory, so the runs are started in a directory holding the benchmarked cities list.
+
+    :param input_dir: Directory of the synthetic granules.
+    :param cities_list: GeoJSON feature collection of the city areas.
+    :param work_dir: Scratch working directory.
+    :param repeat: Number of timed runs.
+    :param arguments: List of further run.py arguments, e.g. ['--workers', '2'].
+    :return: List of durations.
+    """
+
+    with open(os.path.join(work_dir, 'cities_areas.json'), 'w', encoding='utf-8') as json_file:
+        json.dump(cities_list, json_file)
+
+    output_dir = os.path.join(work_dir, 'output')
+    command = [sys.executable, os.path.abspath(run.__file__), '--input-dir', input_dir,
+               '--output-dir', output_dir] + arguments
+
+    def run_main():
+        shutil.rmtree(output_dir, ignore_errors=True)
+        subprocess.run(command, cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+
+    return measure(run_main, repeat)
+
+
+def print_timings(timings, baseline=None):
+    """
+    Prints the best and median durations, and the ratio of the best durations to a baseline.
+
+    :param timings: Dictionary of benchmark name -> list of durations.
+    :param baseline: Optional timings of a previous run, see --output.
+    :return: None
+    """
+
+    print('{:<16}{:>12}{:>12}{:>12}'.format('Benchmark', 'Best [s]', 'Median [s]', 'Baseline'))
+    for name, durations in timings.items():
+        ratio = ''
+        if baseline and name in baseline:
+            ratio = '{:.2f}x'.format(min(durations) / min(baseline[name]))
+        print('{:<16}{:>12.4f}{:>12.4f}{:>12}'.format(name, min(durations), statistics.median(durations), ratio))
+
+
+def parse_arguments():
+    """
+    Parses the command line arguments.
+
+    :return: argparse.Namespace with the parsed arguments.
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmarks run.py on synthetic Sentinel-5P granules.')
+    parser.add_argument('--cities', type=int, default=None,
+                        help='Number of cities taken from cities_areas.json. Defaults to all cities.')
+    parser.add_argument('--scanlines', type=int, default=3245,
+                        help='Number of scanlines of a granule.')
+    parser.add_argument('--pixels', type=int, default=450,
+                        help='Number of ground pixels of a scanline.')
+    parser.add_argument('--bands', type=int, default=32,
+                        help='Number of spectral channels of the L1B radiance granule.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs of every benchmark.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random values of the granules.')
+    parser.add_argument('--skip-main', action='store_true',
+                        help='Skip the end-to-end runs of run.py.')
+    parser.add_argument('--main-args', default='',
+                        help="Further run.py arguments of the end-to-end runs, e.g. '--workers 2'.")
+    parser.add_argument('--output', default=None,
+                        help='Save the timings to a JSON file.')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON file of previous timings, see --output, to compare with.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    with open('cities_areas.json', encoding='utf-8') as f:
+        cities_list = json.load(f)
+    cities_list['features'] = cities_list['features'][:args.cities]
+    print('Cities:', len(cities_list['features']))
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        input_dir = os.path.join(work_dir, 'input')
+        scratch_dir = os.path.join(work_dir, 'scratch')
+        os.makedirs(input_dir)
+        os.makedirs(scratch_dir)
+
+        filenames = {}
+        for file_type in BENCHMARK_PRODUCTS:
+            filenames[file_type] = os.path.join(input_dir, GRANULE_FILENAME.format(file_type))
+            write_granule(filenames[file_type], file_type, args.scanlines, args.pixels, args.bands, args.seed)
+
+        timings = benchmark_functions(filenames['L2__O3____'], cities_list, scratch_dir, args.repeat)
+        if not args.skip_main:
+            timings['main'] = benchmark_main(input_dir, cities_list, work_dir, args.repeat, args.main_args.split())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_timings(timings, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(timings, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
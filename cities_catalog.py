@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+# WKB byte order flag of little-endian data and geometry type code of a polygon, ogr.wkbPolygon
+WKB_LITTLE_ENDIAN = 1
+WKB_POLYGON = 3
+
+
+def get_polygons_wkb(rings):
+    """
+    Encodes single ring polygons of the same number of points as little-endian WKB.
+
+    :param rings: (n, points, 2) array of closed (lon, lat) rings.
+    :return: (n, size) uint8 array, every row is the WKB of a polygon.
+    """
+
+    rings = np.ascontiguousarray(rings, dtype='<f8')
+    # Byte order, geometry type, number of rings and number of points
+    header = np.array([WKB_LITTLE_ENDIAN], dtype='u1').tobytes() \
+        + np.array([WKB_POLYGON, 1, rings.shape[1]], dtype='<u4').tobytes()
+
+    wkb = np.empty((rings.shape[0], len(header) + rings.shape[1] * 16), dtype='u1')
+    wkb[:, :len(header)] = np.frombuffer(header, dtype='u1')
+    wkb[:, len(header):] = rings.reshape(rings.shape[0], -1).view('u1')
+    return wkb
+
+
+def get_polygon_wkb(ring):
+    """
+    Encodes a single ring polygon as little-endian WKB, see get_polygons_wkb.
+
+    :param ring: (points, 2) array of closed (lon, lat) ring points.
+    :return: bytes
+    """
+
+    return get_polygons_wkb(np.asarray(ring)[np.newaxis])[0].tobytes()
+
+
+def create_catalog(cities_list):
+    """
+    Creates the catalog of the city areas, a structured array with the city metadata, bounding box
+    and WKB polygon of every city. Rings shorter than the longest ring are padded by repeating
+    their closing point, so all polygons have the same WKB size.
+
+    :param cities_list: GeoJSON feature collection of the city areas, see cities_list.generate_bounding_boxes.
+    :return: Structured array of the cities.
+    """
+
+    features = cities_list['features']
+    properties = [feature['properties'] for feature in features]
+    rings = [feature['geometry']['coordinates'][0] for feature in features]
+
+    points = max((len(ring) for ring in rings), default=1)
+    padded_rings = np.array([ring + ring[-1:] * (points - len(ring)) for ring in rings],
+                            dtype=np.float64).reshape(len(rings), points, 2)
+    wkb = get_polygons_wkb(padded_rings)
+
+    def text_field(name, key):
+        return name, 'U{}'.format(max((len(str(city[key])) for city in properties), default=1))
+
+    catalog = np.empty(len(features), dtype=[
+        text_field('country', 'country'),
+        text_field('name_utf8', 'name-UTF8'),
+        text_field('name_ascii', 'name-ASCII'),
+        ('population', np.int64),
+        ('min_lon', np.float64),
+        ('min_lat', np.float64),
+        ('max_lon', np.float64),
+        ('max_lat', np.float64),
+        ('wkb', 'u1', (wkb.shape[1],)),
+    ])
+
+    catalog['country'] = [city['country'] for city in properties]
+    catalog['name_utf8'] = [city['name-UTF8'] for city in properties]
+    catalog['name_ascii'] = [city['name-ASCII'] for city in properties]
+    catalog['population'] = [city['population'] for city in properties]
+    catalog['min_lon'] = padded_rings[:, :, 0].min(axis=1)
+    catalog['min_lat'] = padded_rings[:, :, 1].min(axis=1)
+    catalog['max_lon'] = padded_rings[:, :, 0].max(axis=1)
+    catalog['max_lat'] = padded_rings[:, :, 1].max(axis=1)
+    catalog['wkb'] = wkb
+
+    return catalog
+
+
+def write_catalog(filename, catalog):
+    """
+    Saves the catalog as a *.npy file.
+
+    :param filename: Path to the destination .npy file.
+    :param catalog: Structured array returned by create_catalog.
+    :return: None
+    """
+
+    np.save(filename, catalog, allow_pickle=False)
+
+
+def read_catalog(filename):
+    """
+    Memory-maps a catalog saved by write_catalog.
+
+    :param filename: Path to the .npy file.
+    :return: Read-only structured array of the cities.
+    """
+
+    return np.load(filename, mmap_mode='r', allow_pickle=False)
+
+
+def convert_geojson(geojson_filename, catalog_filename=None):
+    """
+    Builds the catalog of a city areas GeoJSON file and saves it, see create_catalog and write_catalog.
+
+    :param geojson_filename: Path to the city areas GeoJSON file, see cities_list.generate_bounding_boxes.
+    :param catalog_filename: Path to the destination .npy file. Defaults to the GeoJSON file name with the
+        .npy extension.
+    :return: Path to the catalog file.
+    """
+
+    if catalog_filename is None:
+        catalog_filename = os.path.splitext(geojson_filename)[0] + '.npy'
+
+    with open(geojson_filename, encoding='utf-8') as f:
+        catalog = create_catalog(json.load(f))
+    write_catalog(catalog_filename, catalog)
+    return catalog_filename
+
+
+def parse_arguments():
+    """
+    Parses the command line arguments.
+
+    :return: argparse.Namespace with the parsed arguments.
+    """
+
+    parser = argparse.ArgumentParser(description='Builds the binary city areas catalog read by run.py.')
+    parser.add_argument('geojson', nargs='?', default='cities_areas.json',
+                        help='City areas GeoJSON file.')
+    parser.add_argument('--output', default=None,
+                        help='Destination .npy file. Defaults to the GeoJSON file name with the .npy extension.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    catalog_filename = convert_geojson(args.geojson, args.output)
+    print('Cities:', len(read_catalog(catalog_filename)), '->', catalog_filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,195 +1,218 @@
+import os
 import time
 from datetime import timedelta
 import csv
 import json
-import copy
-import geopy.distance
+import numpy as np
+from scipy.spatial import cKDTree
+
+import cities_catalog
+from geodesy import EARTH_RADIUS, haversine_distances, to_unit_vectors, vincenty_distances
 
-import ogr
 import osr
 
+# Relative widening of the KD-tree search radius, the geodesic distances on the WGS84 ellipsoid differ
+# from the distances on the mean radius sphere by less than 0.6%
+RADIUS_MARGIN = 0.01
+
+# Columns of the GeoNames dump read by read_geonames, see http://download.geonames.org/export/dump/readme.txt
+GEONAMES_FIELDS = {
+    'country': 8,
+    'name': 1,
+    'asciiname': 2,
+    'population': 14,
+    'latitude': 4,
+    'longitude': 5,
+}
+
+# Half of the side of the city squares in meters, see generate_bounding_boxes
+BOX_HALF_SIZE = 25000
 
-def read_cities_list(filename, max_longitude=None, min_population=None):
-    cities = []
 
-    if max_longitude and min_population:
-        # cities15000.txt a file from the GeoNames project
-        # https://www.geonames.org/
-        # http://download.geonames.org/export/dump/
-        with open('source/cities15000.txt', encoding='utf-8') as csv_file:
-            read_csv = csv.reader(csv_file, delimiter='\t')
-            for row in read_csv:
-                if row[8] in country_codes.values() and float(row[5]) < max_longitude and int(row[14]) > min_population:
-                    cities.append((row[8], row[1], row[2], int(row[14]), float(row[4]), float(row[5])))
-    elif max_longitude:
-        # cities15000.txt a file from the GeoNames project
-        # https://www.geonames.org/
-        # http://download.geonames.org/export/dump/
-        with open('source/cities15000.txt', encoding='utf-8') as csv_file:
-            read_csv = csv.reader(csv_file, delimiter='\t')
-            for row in read_csv:
-                if row[8] in country_codes.values() and float(row[5]) < max_longitude:
-                    cities.append((row[8], row[1], row[2], int(row[14]), float(row[4]), float(row[5])))
-
-    elif min_population:
-        # cities15000.txt a file from the GeoNames project
-        # https://www.geonames.org/
-        # http://download.geonames.org/export/dump/
-        with open('source/cities15000.txt', encoding='utf-8') as csv_file:
-            read_csv = csv.reader(csv_file, delimiter='\t')
-            for row in read_csv:
-                if row[8] in country_codes.values() and int(row[14]) > min_population:
-                    cities.append((row[8], row[1], row[2], int(row[14]), float(row[4]), float(row[5])))
-    else:
-        with open('cities.csv', encoding='utf-8') as csv_file:
-            read_csv = csv.reader(csv_file, delimiter=',')
-            for row in read_csv:
-                    cities.append(row)
+def read_geonames(filename):
+    """
+    Reads a GeoNames cities dump, e.g. cities15000.txt, into a structured array with the GEONAMES_FIELDS
+    columns. The array is cached next to the dump as a *.npz file, which is used as long as the size and
+    modification time of the dump do not change.
+
+    :param filename: Path to the tab-separated GeoNames dump.
+    :return: Structured array of the cities.
+    """
+
+    stat = os.stat(filename)
+    cache_filename = filename + '.npz'
+
+    if os.path.exists(cache_filename):
+        with np.load(cache_filename) as cache:
+            if cache['size'] == stat.st_size and cache['mtime'] == stat.st_mtime_ns:
+                return cache['cities']
+
+    with open(filename, encoding='utf-8', newline='') as csv_file:
+        read_csv = csv.reader(csv_file, delimiter='\t', quoting=csv.QUOTE_NONE)
+        rows = [tuple(row[column] for column in GEONAMES_FIELDS.values()) for row in read_csv]
+
+    columns = list(zip(*rows)) or [()] * len(GEONAMES_FIELDS)
+    cities = np.empty(len(rows), dtype=[
+        ('country', 'U2'),
+        ('name', 'U{}'.format(max(map(len, columns[1]), default=1))),
+        ('asciiname', 'U{}'.format(max(map(len, columns[2]), default=1))),
+        ('population', np.int64),
+        ('latitude', np.float64),
+        ('longitude', np.float64),
+    ])
+    for field, column in zip(GEONAMES_FIELDS, columns):
+        cities[field] = column
+
+    np.savez(cache_filename, cities=cities, size=stat.st_size, mtime=stat.st_mtime_ns)
     return cities
 
 
+def read_cities_list(filename='source/cities15000.txt', max_longitude=None, min_population=None):
+    """
+    Reads the cities of the countries in country_codes from a GeoNames dump, see read_geonames.
+
+    :param filename: Path to the GeoNames dump.
+    :param max_longitude: Optional, only the cities west of the longitude are kept.
+    :param min_population: Optional, only the cities with a bigger population are kept.
+    :return: List of cities in (country code, city name in UTF-8, city name in ASCII, city population,
+        latitude, longitude) format.
+    """
+
+    # cities15000.txt a file from the GeoNames project
+    # https://www.geonames.org/
+    # http://download.geonames.org/export/dump/
+    cities = read_geonames(filename)
+
+    mask = np.isin(cities['country'], list(country_codes.values()))
+    if max_longitude:
+        mask &= cities['longitude'] < max_longitude
+    if min_population:
+        mask &= cities['population'] > min_population
+
+    return cities[mask].tolist()
+
+
 def aggregate_cities(break_values, cities_list):
     """
     Deletes smaller cities around bigger cities. It takes break values from a list of lists or tuples in
     [population limit, distance limit] format.
 
-    :param break_values:
-    :param cities_list:
-    :return:
+    The cities are visited from the biggest one. Every remaining city bigger than the population limit
+    deletes the cities with a different name closer than the distance limit. The candidates are found by
+    a KD-tree over 3D unit vectors with a slightly widened radius. Their haversine distances decide unless
+    they are within RADIUS_MARGIN of the distance limit, only those distances are refined on the
+    ellipsoid, see vincenty_distances.
+
+    :param break_values: List of (population limit, distance limit in kilometers) tuples.
+    :param cities_list: List of cities in [country code, city name in UTF-8, city name in ASCII,
+        city population, latitude, longitude] format.
+    :return: List of the remaining cities sorted by population.
     """
 
     cities_list.sort(key=lambda tup: tup[3], reverse=True)
 
+    coordinates = np.array([(city[4], city[5]) for city in cities_list], dtype=np.float64).reshape(-1, 2)
+    vectors = to_unit_vectors(coordinates[:, 0], coordinates[:, 1])
+    tree = cKDTree(vectors)
+    names = np.array([city[1] for city in cities_list], dtype=object)
+    removed = np.zeros(len(cities_list), dtype=bool)
+
     for break_value in break_values:
         print('\n\033[94mPopulation break:\033[0m', break_value[0], '\033[94mDistance break:\033[0m', break_value[1])
-        for bigger_city in cities_list:
-            if bigger_city[3] > break_value[0]:
-                bigger_city_coordinates = (bigger_city[4], bigger_city[5])
-                bigger_city_name = bigger_city[1]
-                cities_list_copy = copy.copy(cities_list)
-
-                for city in cities_list_copy:
-                    city_coordinates = (city[4], city[5])
-                    city_name = city[1]
-                    distance = geopy.distance.geodesic(bigger_city_coordinates, city_coordinates).km
-
-                    if distance < break_value[1] and city_name != bigger_city_name:
-                        print(bigger_city[0], bigger_city[1], city[1], distance)
-                        cities_list.remove(city)
-
-        print('\033[94mNumber of cities:\033[0m', len(cities))
-
-    return cities_list
-
-
-def generate_bounding_boxes(cities_list):
-    def transform_point(coordinates, source_crs, target_crs):
-
-        point = ogr.Geometry(ogr.wkbPoint)
-        point.AddPoint(coordinates[0], coordinates[1])
-
-        transform = osr.CoordinateTransformation(source_crs, target_crs)
-        point.Transform(transform)
-
-        return [point.GetX(), point.GetY()]
-
-    def get_UTM_EPSG_code(longitude):
-        if -30.0 <= longitude < -24.0:
-            # UTM zone 26
-            return 32626
-        elif -24.0 <= longitude < -18.0:
-            # UTM zone 27
-            return 32627
-        elif -18.0 <= longitude < -12.0:
-            # UTM zone 28
-            return 32628
-        elif -12.0 <= longitude < -6.0:
-            # UTM zone 29
-            return 32629
-        elif -6.0 <= longitude < 0.0:
-            # UTM zone 30
-            return 32630
-        elif 0.0 <= longitude < 6.0:
-            # UTM zone 31
-            return 32631
-        elif 6.0 <= longitude < 12.0:
-            # UTM zone 32
-            return 32632
-        elif 12.0 <= longitude < 18.0:
-            # UTM zone 33
-            return 32633
-        elif 18.0 <= longitude < 24.0:
-            # UTM zone 34
-            return 32634
-        elif 24.0 <= longitude < 30.0:
-            # UTM zone 35
-            return 32635
-        elif 30.0 <= longitude < 36.0:
-            # UTM zone 36
-            return 32636
-        elif 36.0 <= longitude < 42.0:
-            # UTM zone 37
-            return 32637
-        elif 42.0 <= longitude < 48.0:
-            # UTM zone 38
-            return 32638
-        elif 48.0 <= longitude < 54.0:
-            # UTM zone 39
-            return 32639
-        elif 54.0 <= longitude < 60.0:
-            # UTM zone 40
-            return 32640
-        elif 60.0 <= longitude < 66.0:
-            # UTM zone 41
-            return 32641
-        elif 66.0 <= longitude < 72.0:
-            # UTM zone 42
-            return 32642
-        else:
-            return None
-
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(4326)
-
-    target = osr.SpatialReference()
-    # target.ImportFromEPSG(3035)
-    target.ImportFromEPSG(32633)
 
-    cities_json = {
-        'type': 'FeatureCollection',
-        'features': [],
-    }
+        # Chord length of the distance limit on the sphere, widened to cover the ellipsoid distances
+        radius = 2.0 * np.sin(break_value[1] * (1.0 + RADIUS_MARGIN) / (2.0 * EARTH_RADIUS))
 
-    for city in cities_list:
-        city_coordinates = (city[4], city[5])
+        for i, bigger_city in enumerate(cities_list):
+            if bigger_city[3] <= break_value[0]:
+                break
+            if removed[i]:
+                continue
 
-        source = osr.SpatialReference()
-        source.ImportFromEPSG(4326)
+            candidates = np.sort(np.array(tree.query_ball_point(vectors[i], radius), dtype=np.int64))
+            candidates = candidates[~removed[candidates] & (names[candidates] != bigger_city[1])]
 
-        epsg = get_UTM_EPSG_code(city_coordinates[1])
+            distances = haversine_distances(coordinates[i], coordinates[candidates])
+            near = np.abs(distances - break_value[1]) < break_value[1] * RADIUS_MARGIN
+            distances[near] = vincenty_distances(coordinates[i], coordinates[candidates[near]])
 
-        target = osr.SpatialReference()
+            within = distances < break_value[1]
+            for j, distance in zip(candidates[within], distances[within]):
+                print(bigger_city[0], bigger_city[1], cities_list[j][1], distance)
+            removed[candidates[within]] = True
 
-        target.ImportFromEPSG(epsg)
+        print('\033[94mNumber of cities:\033[0m', np.count_nonzero(~removed))
 
-        point = ogr.Geometry(ogr.wkbPoint)
-        point.AddPoint(city_coordinates[1], city_coordinates[0])
+    return [city for city, city_removed in zip(cities_list, removed) if not city_removed]
 
-        transform = osr.CoordinateTransformation(source, target)
-        point.Transform(transform)
 
-        city_coordinates_UTM = []
+def get_utm_epsg_codes(latitudes, longitudes):
+    """
+    Calculates the EPSG codes of the WGS84 / UTM zones of the points, 326xx north and 327xx south
+    of the equator.
 
-        city_coordinates_UTM.append([point.GetX() - 25000, point.GetY() + 25000])
-        city_coordinates_UTM.append([point.GetX() + 25000, point.GetY() + 25000])
-        city_coordinates_UTM.append([point.GetX() + 25000, point.GetY() - 25000])
-        city_coordinates_UTM.append([point.GetX() - 25000, point.GetY() - 25000])
-        city_coordinates_UTM.append(city_coordinates_UTM[0])
+    :param latitudes: Array of latitudes.
+    :param longitudes: Array of longitudes in the [-180, 180] range.
+    :return: Array of EPSG codes.
+    """
 
-        city_coordinates_WGS84 = city_coordinates_UTM
-        city_coordinates_UTM[:] = [transform_point(x, target, source) for x in city_coordinates_UTM]
-        print(city)
+    zones = np.clip(np.floor((np.asarray(longitudes) + 180.0) / 6.0).astype(np.int64) + 1, 1, 60)
+    return np.where(np.asarray(latitudes) < 0.0, 32700, 32600) + zones
+
+
+def get_spatial_reference(epsg):
+    """
+    Creates a spatial reference with the (x, y) = (longitude, latitude) axis order.
 
+    :param epsg: EPSG code.
+    :return: osr.SpatialReference
+    """
+
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(int(epsg))
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return spatial_reference
+
+
+def generate_bounding_boxes(cities_list, filename='cities_areas.json'):
+    """
+    Saves the (2 * BOX_HALF_SIZE) m squares around the cities, aligned with their UTM zone grid, as
+    a GEOJSON file of polygons. The cities of a zone are transformed together, once to the zone and
+    once back for the square corners. The binary catalog read by run.py is saved next to the GEOJSON
+    file as a *.npy file, see cities_catalog.
+
+    :param cities_list: List of lists or tuples in [country code, city name in UTF-8, city name in ASCII,
+        city population, latitude, longitude] format.
+    :param filename: Path to the destination .json file.
+    :return: None
+    """
+
+    coordinates = np.array([(city[4], city[5]) for city in cities_list], dtype=np.float64).reshape(-1, 2)
+    epsg_codes = get_utm_epsg_codes(coordinates[:, 0], coordinates[:, 1])
+
+    source = get_spatial_reference(4326)
+    # Square corners, the first corner closes the ring
+    corners = BOX_HALF_SIZE * np.array([[-1, 1], [1, 1], [1, -1], [-1, -1], [-1, 1]], dtype=np.float64)
+    rings = np.empty((len(cities_list), len(corners), 2))
+
+    for epsg in np.unique(epsg_codes):
+        in_zone = np.flatnonzero(epsg_codes == epsg)
+        target = get_spatial_reference(epsg)
+
+        transform = osr.CoordinateTransformation(source, target)
+        points = np.array(transform.TransformPoints(coordinates[in_zone][:, ::-1].tolist()))[:, :2]
+
+        retransform = osr.CoordinateTransformation(target, source)
+        ring_points = (points[:, np.newaxis, :] + corners).reshape(-1, 2)
+        rings[in_zone] = np.array(retransform.TransformPoints(ring_points.tolist()))[:, :2].reshape(-1, len(corners), 2)
+
+    cities_json = {
+        'type': 'FeatureCollection',
+        'features': [],
+    }
+
+    for city, ring in zip(cities_list, rings.tolist()):
         feature = {
             'type': 'Feature',
             'properties': {
@@ -201,21 +224,16 @@ def generate_bounding_boxes(cities_list):
             'geometry': {
                 'type': 'Polygon',
                 'coordinates': [
-                    city_coordinates_WGS84
+                    ring
                 ]
             }
         }
         cities_json['features'].append(feature)
 
-        with open('cities_areas.json', 'w', encoding='utf-8') as json_file:
-            json.dump(cities_json, json_file, indent=4, sort_keys=True)
+    with open(filename, 'w', encoding='utf-8') as json_file:
+        json.dump(cities_json, json_file, indent=4, sort_keys=True)
 
-    # for coordinate in coordinates[0]:
-    #     point = ogr.Geometry(ogr.wkbPoint)
-    #     point.AddPoint(coordinate[0], coordinate[1])
-    #     point.Transform(retransform)
-    #     print([point.GetX(), point.GetY()])
-    #     coordinate = [point.GetX(), point.GetY()]
+    cities_catalog.write_catalog(os.path.splitext(filename)[0] + '.npy', cities_catalog.create_catalog(cities_json))
 
 
 def write_csv(filename, cities_list):
@@ -272,8 +290,6 @@ def write_geojson(filename, cities_list):
         json.dump(cities_json, json_file)
 
 
-start = time.time()
-
 country_codes = {
     'Portugal': 'PT',
     'Spain': 'ES',
@@ -325,19 +341,27 @@ breaks = [
     (50000, 50.0),
 ]
 
-cities = []
 
-with open('cities.csv', encoding='utf-8') as csv_file:
-    read_csv = csv.reader(csv_file, delimiter=',')
-    next(read_csv, None)
-    for row in read_csv:
-        cities.append((row[0], row[1], row[2], int(row[3]), float(row[4]), float(row[5])))
+def main():
+    start = time.time()
+
+    cities = []
+
+    with open('cities.csv', encoding='utf-8') as csv_file:
+        read_csv = csv.reader(csv_file, delimiter=',')
+        next(read_csv, None)
+        for row in read_csv:
+            cities.append((row[0], row[1], row[2], int(row[3]), float(row[4]), float(row[5])))
+
+    cities = aggregate_cities(breaks, cities)
+    # generate_bounding_boxes(cities)
+
+    write_geojson('cities.json', cities)
+    write_csv('cities.csv', cities)
 
-cities = aggregate_cities(breaks, cities)
-# generate_bounding_boxes(cities)
+    elapsed = (time.time() - start)
+    print('\033[92mElapsed time:\033[0m', str(timedelta(seconds=elapsed)))
 
-write_geojson('cities.json', cities)
-write_csv('cities.csv', cities)
 
-elapsed = (time.time() - start)
-print('\033[92mElapsed time:\033[0m', str(timedelta(seconds=elapsed)))
+if __name__ == "__main__":
+    main()
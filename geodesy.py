@@ -0,0 +1,100 @@
+import numpy as np
+
+# Mean Earth radius in kilometers
+EARTH_RADIUS = 6371.0088
+
+# WGS84 ellipsoid semi-major axis in kilometers and flattening
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+
+
+def to_unit_vectors(latitudes, longitudes):
+    """
+    Converts geographic coordinates to 3D unit vectors. Chord distances between the vectors grow
+    monotonically with the great circle distances, so a KD-tree over them finds the nearest points
+    on the sphere.
+
+    :param latitudes: Array of latitudes in degrees.
+    :param longitudes: Array of longitudes in degrees.
+    :return: Array of shape latitudes.shape + (3,).
+    """
+
+    latitudes = np.radians(latitudes)
+    longitudes = np.radians(longitudes)
+    cos_latitudes = np.cos(latitudes)
+
+    return np.stack((cos_latitudes * np.cos(longitudes),
+                     cos_latitudes * np.sin(longitudes),
+                     np.sin(latitudes)), axis=-1)
+
+
+def haversine_distances(point, points):
+    """
+    Calculates the great circle distances from a point to an array of points on the mean radius sphere.
+
+    :param point: (latitude, longitude) in degrees.
+    :param points: (n, 2) array of (latitude, longitude) points in degrees.
+    :return: Array of n distances in kilometers.
+    """
+
+    latitude, longitude = np.radians(point)
+    latitudes = np.radians(points[:, 0])
+    longitudes = np.radians(points[:, 1])
+
+    h = np.sin((latitudes - latitude) / 2.0) ** 2 \
+        + np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def vincenty_distances(point, points, iterations=100, tolerance=1e-12):
+    """
+    Calculates the geodesic distances from a point to an array of points on the WGS84 ellipsoid by the
+    Vincenty inverse formula. The distances agree with geopy.distance.geodesic to well below a millimeter,
+    except for nearly antipodal points, where the iteration does not converge.
+
+    :param point: (latitude, longitude) in degrees.
+    :param points: (n, 2) array of (latitude, longitude) points in degrees.
+    :param iterations: Maximum number of iterations.
+    :param tolerance: Convergence limit of the longitude difference on the auxiliary sphere in radians.
+    :return: Array of n distances in kilometers.
+    """
+
+    b = (1.0 - WGS84_F) * WGS84_A
+
+    u1 = np.arctan((1.0 - WGS84_F) * np.tan(np.radians(point[0])))
+    u2 = np.arctan((1.0 - WGS84_F) * np.tan(np.radians(points[:, 0])))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    longitude_difference = np.radians(points[:, 1] - point[1])
+    lambda_ = longitude_difference
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(iterations):
+            sin_lambda, cos_lambda = np.sin(lambda_), np.cos(lambda_)
+            sin_sigma = np.hypot(cos_u2 * sin_lambda, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+
+            # Coincident points have sin_sigma == 0, points on the equator have cos2_alpha == 0
+            sin_alpha = np.where(sin_sigma == 0.0, 0.0, cos_u1 * cos_u2 * sin_lambda / sin_sigma)
+            cos2_alpha = 1.0 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos2_alpha == 0.0, 0.0, cos_sigma - 2.0 * sin_u1 * sin_u2 / cos2_alpha)
+
+            c = WGS84_F / 16.0 * cos2_alpha * (4.0 + WGS84_F * (4.0 - 3.0 * cos2_alpha))
+            previous_lambda = lambda_
+            lambda_ = longitude_difference + (1.0 - c) * WGS84_F * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1.0 + 2.0 * cos_2sigma_m ** 2)))
+
+            if np.all(np.abs(lambda_ - previous_lambda) < tolerance):
+                break
+
+    u_squared = cos2_alpha * (WGS84_A ** 2 - b ** 2) / b ** 2
+    a_coefficient = 1.0 + u_squared / 16384.0 * (
+        4096.0 + u_squared * (-768.0 + u_squared * (320.0 - 175.0 * u_squared)))
+    b_coefficient = u_squared / 1024.0 * (256.0 + u_squared * (-128.0 + u_squared * (74.0 - 47.0 * u_squared)))
+    delta_sigma = b_coefficient * sin_sigma * (cos_2sigma_m + b_coefficient / 4.0 * (
+        cos_sigma * (-1.0 + 2.0 * cos_2sigma_m ** 2)
+        - b_coefficient / 6.0 * cos_2sigma_m * (-3.0 + 4.0 * sin_sigma ** 2) * (-3.0 + 4.0 * cos_2sigma_m ** 2)))
+
+    return b * a_coefficient * (sigma - delta_sigma)
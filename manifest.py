@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+
+
+def get_file_hash(filename):
+    """
+    Calculates the SHA-1 digest of a file.
+
+    :param filename: Path to the file.
+    :return: Hexadecimal digest.
+    """
+
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Record of the processed input files, stored as a JSON lines file. Every processed file appends
+    a line with its name, size, modification time, the hash of the cities list and the outputs.
+    A file is done if its last line matches the current file and cities list and has no errors.
+    Lines are flushed to disk one by one, so the manifest survives a crash of the run.
+
+    :param filename: Path to the manifest *.jsonl file.
+    :param cities_hash: Hash of the cities list, see get_file_hash.
+    """
+
+    def __init__(self, filename, cities_hash):
+        self.filename = filename
+        self.cities_hash = cities_hash
+        self.entries = {}
+        # True if the last line was cut off by a crash and is not terminated
+        self.cut_off = False
+
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as file:
+                for line in file:
+                    self.cut_off = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Line cut off by a crash
+                        continue
+                    self.entries[entry['file']] = entry
+
+    def get_key(self, filepath):
+        """
+        Returns the fields identifying a processed input file.
+
+        :param filepath: Path to the input file.
+        :return: Dictionary with the file name, size, modification time and cities hash.
+        """
+
+        stat = os.stat(filepath)
+        key = {
+            'file': os.path.basename(filepath),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'cities': self.cities_hash,
+        }
+        return key
+
+    def is_done(self, filepath):
+        """
+        Checks if the input file was already processed without errors.
+
+        :param filepath: Path to the input file.
+        :return: bool
+        """
+
+        entry = self.entries.get(os.path.basename(filepath))
+        if entry is None or entry['status'] != 'done':
+            return False
+
+        key = self.get_key(filepath)
+        return all(entry.get(name) == value for name, value in key.items())
+
+    def record(self, filepath, result):
+        """
+        Appends the result of a processed input file to the manifest.
+
+        :param filepath: Path to the input file.
+        :param result: Dictionary returned by run.process_file.
+        :return: None
+        """
+
+        entry = self.get_key(filepath)
+        entry['status'] = 'failed' if result['errors'] else 'done'
+        entry['outputs'] = result['outputs']
+        entry['errors'] = result['errors']
+        entry['elapsed'] = result['elapsed']
+
+        with open(self.filename, 'a', encoding='utf-8') as file:
+            if self.cut_off:
+                file.write('\n')
+                self.cut_off = False
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.entries[entry['file']] = entry
@@ -0,0 +1,155 @@
+import os
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Columns of the metrics files, see write_metrics
+FIELDS = ['file', 'stage', 'city', 'bands', 'seconds', 'bytes']
+
+# Number of lines printed by stop_profiler
+PROFILE_LINES = 25
+
+
+class StageTimer:
+    """
+    Records the duration and the number of processed bytes of the processing stages. Stages can be
+    timed by several threads at once. Timers returned by labelled share the records of this timer.
+
+    :param labels: Fields added to every record, e.g. city or bands.
+    """
+
+    def __init__(self, **labels):
+        self.records = []
+        self.lock = threading.Lock()
+        self.labels = labels
+
+    def labelled(self, **labels):
+        """
+        Returns a timer adding further labels to its records, e.g. the city of the timed stages.
+
+        :param labels: Fields added to every record.
+        :return: StageTimer sharing the records of this timer.
+        """
+
+        timer = StageTimer(**dict(self.labels, **labels))
+        timer.records = self.records
+        timer.lock = self.lock
+        return timer
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block. The yielded record can be given the number of processed bytes:
+
+            with timer.stage('read') as record:
+                values = read_rows(variable, rows)
+                record['bytes'] = values.nbytes
+
+        :param name: Name of the stage.
+        :return: Context manager yielding the record.
+        """
+
+        record = dict(self.labels, stage=name, bytes=None)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            with self.lock:
+                self.records.append(record)
+
+
+def summarize(records):
+    """
+    Sums the durations and bytes of the records by stage.
+
+    :param records: List of records, see StageTimer.
+    :return: Dictionary of stage name: {'count', 'seconds', 'bytes'} in order of first occurrence.
+    """
+
+    summary = {}
+    for record in records:
+        total = summary.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'bytes': 0})
+        total['count'] += 1
+        total['seconds'] += record['seconds']
+        total['bytes'] += record['bytes'] or 0
+    return summary
+
+
+def write_metrics(filename, file, records):
+    """
+    Appends the stage records of an input file to a metrics file. *.csv files are written as CSV with
+    a header line, any other file as JSON lines.
+
+    :param filename: Path to the metrics file.
+    :param file: Name of the input file, written in the 'file' column.
+    :param records: List of records, see StageTimer.
+    :return: None
+    """
+
+    rows = [dict({field: None for field in FIELDS}, **record, file=file) for record in records]
+
+    if filename.endswith('.csv'):
+        write_header = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        with open(filename, 'a', newline='', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=FIELDS, extrasaction='ignore')
+            if write_header:
+                writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(filename, 'a', encoding='utf-8') as json_file:
+            for row in rows:
+                json_file.write(json.dumps(row) + '\n')
+
+
+def start_profiler(kind):
+    """
+    Starts profiling the current process.
+
+    :param kind: 'cprofile' profiles the function calls, 'tracemalloc' traces the memory allocations.
+    :return: cProfile.Profile for 'cprofile', otherwise None.
+    """
+
+    if kind == 'cprofile':
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    import tracemalloc
+
+    tracemalloc.start()
+    return None
+
+
+def stop_profiler(kind, profiler, output_dir):
+    """
+    Stops profiling and prints the top entries. The cProfile statistics are also saved as
+    profile.prof in the output directory, e.g. for snakeviz.
+
+    :param kind: See start_profiler.
+    :param profiler: Object returned by start_profiler.
+    :param output_dir: Path to the output directory.
+    :return: None
+    """
+
+    if kind == 'cprofile':
+        import pstats
+
+        profiler.disable()
+        profiler.dump_stats(os.path.join(output_dir, 'profile.prof'))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        return
+
+    import tracemalloc
+
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for statistic in snapshot.statistics('lineno')[:PROFILE_LINES]:
+        print(statistic)
+    print('Peak traced memory: {:.1f} MB'.format(peak / 2 ** 20))
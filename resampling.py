@@ -0,0 +1,259 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from functools import lru_cache
+
+from geodesy import EARTH_RADIUS, to_unit_vectors
+
+
+def box_filter(x):
+    """
+    Box kernel, averages all source pixels covered by the destination pixel.
+
+    :param x: Array of distances in source pixels.
+    :return: Array of kernel values.
+    """
+
+    return np.where((x > -0.5) & (x <= 0.5), 1.0, 0.0)
+
+
+def triangle_filter(x):
+    """
+    Triangle (bilinear) kernel.
+
+    :param x: Array of distances in source pixels.
+    :return: Array of kernel values.
+    """
+
+    return np.maximum(1.0 - np.abs(x), 0.0)
+
+
+def cubic_filter(x, a=-0.5):
+    """
+    Cubic convolution kernel with the same parameter as the PIL bicubic filter.
+
+    :param x: Array of distances in source pixels.
+    :param a: Kernel parameter.
+    :return: Array of kernel values.
+    """
+
+    x = np.abs(x)
+    return np.where(x < 1.0, ((a + 2.0) * x - (a + 3.0)) * x * x + 1.0,
+                    np.where(x < 2.0, (((x - 5.0) * x + 8.0) * x - 4.0) * a, 0.0))
+
+
+# Resampling methods, (support, kernel) tuples. 'nearest' has no kernel, see resize_weights.
+METHODS = {
+    'nearest': (None, None),
+    'area': (0.5, box_filter),
+    'bilinear': (1.0, triangle_filter),
+    'bicubic': (2.0, cubic_filter),
+}
+
+
+@lru_cache(maxsize=256)
+def resize_weights(src_size, dst_size, method):
+    """
+    Calculates a (dst_size, src_size) matrix of interpolation weights along one axis. The convolution
+    weights follow the PIL resampling filters, including the widened support when downsampling, so a
+    matrix product with the weights gives the same result as Image.resize.
+
+    :param src_size: Source axis length.
+    :param dst_size: Destination axis length.
+    :param method: Key of METHODS.
+    :return: Read-only float32 array of weights.
+    """
+
+    support, kernel = METHODS[method]
+    scale = src_size / dst_size
+
+    if kernel is None:
+        weights = np.zeros((dst_size, src_size))
+        nearest = np.minimum(((np.arange(dst_size) + 0.5) * scale).astype(np.int64), src_size - 1)
+        weights[np.arange(dst_size), nearest] = 1.0
+    else:
+        filter_scale = max(scale, 1.0)
+        support *= filter_scale
+
+        centers = (np.arange(dst_size) + 0.5) * scale
+        x_min = np.maximum((centers - support + 0.5).astype(np.int64), 0)
+        x_max = np.minimum((centers + support + 0.5).astype(np.int64), src_size)
+
+        x = np.arange(src_size)
+        weights = kernel((x[np.newaxis, :] - centers[:, np.newaxis] + 0.5) / filter_scale)
+        weights[(x[np.newaxis, :] < x_min[:, np.newaxis]) | (x[np.newaxis, :] >= x_max[:, np.newaxis])] = 0.0
+
+        total = weights.sum(axis=1, keepdims=True)
+        weights = np.divide(weights, total, out=np.zeros_like(weights), where=total != 0.0)
+
+    weights = weights.astype(np.float32)
+    weights.setflags(write=False)
+    return weights
+
+
+def get_weights(src_shape, n, method):
+    """
+    Returns the row and column weights resizing an array of src_shape to (n, n). The weights are
+    cached, so they are calculated once for every (src_shape, n, method) combination.
+
+    :param src_shape: Shape of the source array, only the first two axes are used.
+    :param n: Destination size.
+    :param method: Key of METHODS.
+    :return: Tuple of row and column weights.
+    """
+
+    return resize_weights(src_shape[0], n, method), resize_weights(src_shape[1], n, method)
+
+
+def apply_weights(weights, arr):
+    """
+    Applies row and column weights to the first two axes of an array. Any further axes, e.g. bands,
+    are resized together in a single batched operation.
+
+    :param weights: Tuple of row and column weights, see get_weights.
+    :param arr: Array of shape (rows, cols) or (rows, cols, bands).
+    :return: Resized array.
+    """
+
+    row_weights, col_weights = weights
+    arr = np.tensordot(row_weights, arr, axes=(1, 0))
+    return np.moveaxis(np.tensordot(col_weights, arr, axes=(1, 1)), 0, 1)
+
+
+def resize(arr, n, method='bilinear', weights=None):
+    """
+    Resizes the first two axes of an array to (n, n). Masked and NaN cells are left out of the
+    interpolation and the weights of the remaining cells are renormalized. A destination cell is
+    masked if less than half of its interpolation weight comes from valid cells.
+
+    :param arr: Array or masked array of shape (rows, cols) or (rows, cols, bands).
+    :param n: Destination size.
+    :param method: Key of METHODS.
+    :param weights: Optional precomputed weights, see get_weights.
+    :return: float32 masked array of shape (n, n) or (n, n, bands).
+    """
+
+    if weights is None:
+        weights = get_weights(arr.shape, n, method)
+
+    data = np.ma.getdata(arr).astype(np.float32, copy=False)
+    valid = ~np.ma.getmaskarray(arr) & np.isfinite(data)
+
+    if valid.all():
+        return np.ma.MaskedArray(apply_weights(weights, data))
+
+    values = apply_weights(weights, np.where(valid, data, np.float32(0.0)))
+    support = apply_weights(weights, valid.astype(np.float32))
+
+    mask = support < 0.5
+    values = np.divide(values, support, out=np.full_like(values, np.nan), where=~mask)
+
+    return np.ma.MaskedArray(values, mask=mask)
+
+
+def grid_coordinates(bbox, n):
+    """
+    Calculates the cell coordinates of a (n, n) grid over bbox. The cells are placed in the same way
+    as in the GeoTIFF files written by run.write_geotiff.
+
+    :param bbox: Bounding box of the grid.
+    :param n: Grid size.
+    :return: Tuple of (n, n) latitude and longitude arrays.
+    """
+
+    pixel_width = (bbox['max_lon'] - bbox['min_lon']) / n
+    pixel_height = (bbox['max_lat'] - bbox['min_lat']) / n
+
+    latitudes = bbox['max_lat'] - np.arange(n) * pixel_height
+    longitudes = bbox['min_lon'] + np.arange(n) * pixel_width
+
+    return np.meshgrid(latitudes, longitudes, indexing='ij')
+
+
+def swath_neighbours(latitudes, longitudes, bbox, n, window=None, k=4, max_distance=15.0):
+    """
+    Finds the swath pixels nearest to the cells of a (n, n) grid over bbox and their inverse distance
+    weights. The result maps the curvilinear swath straight onto the grid and can be applied to any
+    variable or band sharing the geolocation, see apply_neighbours.
+
+    :param latitudes: 2D array of pixel latitudes.
+    :param longitudes: 2D array of pixel longitudes.
+    :param bbox: Bounding box of the grid.
+    :param n: Grid size.
+    :param window: Optional (rows, cols) tuple of slices limiting the searched swath pixels.
+    :param k: Number of neighbours of a grid cell.
+    :param max_distance: Neighbours further than max_distance kilometers are left out.
+    :return: Dictionary with the window, neighbour indices and weights, or None if no grid cell has
+        a neighbour.
+    """
+
+    if window is not None:
+        latitudes = latitudes[window]
+        longitudes = longitudes[window]
+
+    latitudes = np.ma.filled(np.ma.asarray(latitudes, dtype=np.float64), np.nan).ravel()
+    longitudes = np.ma.filled(np.ma.asarray(longitudes, dtype=np.float64), np.nan).ravel()
+
+    source = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+    if source.size == 0:
+        return None
+    k = min(k, source.size)
+
+    tree = cKDTree(to_unit_vectors(latitudes[source], longitudes[source]))
+    grid_latitudes, grid_longitudes = grid_coordinates(bbox, n)
+    distances, indices = tree.query(to_unit_vectors(grid_latitudes.ravel(), grid_longitudes.ravel()),
+                                    k=k, distance_upper_bound=max_distance / EARTH_RADIUS)
+
+    distances = distances.reshape(n * n, k)
+    indices = indices.reshape(n * n, k)
+
+    found = np.isfinite(distances)
+    if not found.any():
+        return None
+
+    weights = np.zeros(distances.shape, dtype=np.float32)
+    weights[found] = 1.0 / np.maximum(distances[found], 1e-9) ** 2
+
+    neighbours = {
+        'window': window,
+        'indices': np.where(found, source[np.minimum(indices, source.size - 1)], 0),
+        'weights': weights,
+        'n': n,
+    }
+    return neighbours
+
+
+def apply_neighbours(values, neighbours):
+    """
+    Resamples values onto the grid described by neighbours. Masked and NaN pixels are left out and
+    the weights of the remaining neighbours are renormalized.
+
+    :param values: Array or masked array of shape (rows, cols) or (rows, cols, bands) sharing the
+        geolocation used in swath_neighbours.
+    :param neighbours: Dictionary returned by swath_neighbours.
+    :return: float32 masked array of shape (n, n) or (n, n, bands).
+    """
+
+    if neighbours['window'] is not None:
+        values = values[neighbours['window']]
+
+    data = np.ma.getdata(values)
+    data = data.reshape((-1,) + data.shape[2:])
+    valid = ~np.ma.getmaskarray(values).reshape(data.shape) & np.isfinite(data)
+
+    indices = neighbours['indices']
+    weights = neighbours['weights'].reshape(indices.shape + (1,) * (data.ndim - 1))
+
+    gathered_valid = valid[indices]
+    weights = np.where(gathered_valid, weights, np.float32(0.0))
+    total = weights.sum(axis=1)
+
+    gathered = np.where(gathered_valid, data[indices], np.float32(0.0))
+    values = (gathered * weights).sum(axis=1, dtype=np.float32)
+
+    mask = total == 0.0
+    values = np.divide(values, total, out=np.full_like(values, np.nan), where=~mask)
+
+    n = neighbours['n']
+    shape = (n, n) + data.shape[1:]
+    return np.ma.MaskedArray(values.reshape(shape), mask=mask.reshape(shape))
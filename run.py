@@ -1,16 +1,27 @@
 import os
+import sys
 import netCDF4 as nC
 import numpy as np
 import png
-import csv
+import gzip
 import json
 from osgeo import gdal, osr, ogr
-import struct
-from PIL import Image
 
-from operator import itemgetter
+import resampling
+import cities_catalog
+import metrics
+from manifest import Manifest, get_file_hash
+
 from datetime import timedelta
 import time
+import argparse
+import re
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 
 # from scipy.misc import imresize
 
@@ -21,139 +32,657 @@ import time
 # python "C:\Users\SR-CleanRoom\AppData\Local\Programs\Python\Python37\Scripts\kernprof.exe" -l -v run.py
 #
 
-
-def regrid(latitudes, longitudes, values, n):
+# Sentinel-5P file name, e.g. S5P_OFFL_L2__O3_____20190101T100000_20190101T114000_06290_01_010105_20190107T112345.nc
+FILENAME_PATTERN = re.compile(
+    r'^(?P<platform>[A-Z0-9]{3})_(?P<stream>[A-Z]{4})_(?P<file_type>[A-Z0-9_]{10})'
+    r'_(?P<start>\d{8}T\d{6})_(?P<end>\d{8}T\d{6})_(?P<orbit>\d{5})_(?P<collection>\d{2})'
+    r'_(?P<processor>\d{6})_(?P<production>\d{8}T\d{6})\.nc$'
+)
+
+# Group of the product footprint attribute, see get_product_extent
+FOOTPRINT_GROUP = 'METADATA/EOP_METADATA/om:featureOfInterest/eop:multiExtentOf/gml:surfaceMembers/gml:exterior'
+
+# Ring of the valid longitude and latitude range, see get_footprint_geometry
+WORLD_RING = np.array([[-180.0, -90.0], [180.0, -90.0], [180.0, 90.0], [-180.0, 90.0], [-180.0, -90.0]])
+
+# Products by the file type field of the file name. 'name' is the product type of the output files,
+# 'group' and 'geolocation' are the groups of the data variable and of the latitude and longitude
+# variables, 'date_field' is the field of the file name used as the sensing date of the output files.
+# Level 1B radiance variables have a trailing spectral channel axis, see get_band_chunks.
+PRODUCTS = {
+    'L2__CLOUD_': {
+        'name': 'CLOUD',
+        'level': 'L2',
+        'group': '/PRODUCT',
+        'geolocation': '/PRODUCT',
+        'variable': 'cloud_optical_thickness',
+        'date_field': 'end',
+    },
+    'L2__SO2___': {
+        'name': 'SO2',
+        'level': 'L2',
+        'group': '/PRODUCT',
+        'geolocation': '/PRODUCT',
+        'variable': 'sulfurdioxide_total_vertical_column',
+        'date_field': 'end',
+    },
+    'L2__O3____': {
+        'name': 'O3',
+        'level': 'L2',
+        'group': '/PRODUCT',
+        'geolocation': '/PRODUCT',
+        'variable': 'ozone_total_vertical_column',
+        'date_field': 'end',
+    },
+    'L2__NO2___': {
+        'name': 'NO2',
+        'level': 'L2',
+        'group': '/PRODUCT',
+        'geolocation': '/PRODUCT',
+        'variable': 'nitrogendioxide_tropospheric_column',
+        'date_field': 'end',
+    },
+    'L2__CH4___': {
+        'name': 'CH4',
+        'level': 'L2',
+        'group': '/PRODUCT',
+        'geolocation': '/PRODUCT',
+        'variable': 'methane_mixing_ratio',
+        'date_field': 'end',
+    },
+    'L2__HCHO__': {
+        'name': 'HCHO',
+        'level': 'L2',
+        'group': '/PRODUCT',
+        'geolocation': '/PRODUCT',
+        'variable': 'formaldehyde_tropospheric_vertical_column',
+        'date_field': 'end',
+    },
+    'L2__AER_AI': {
+        'name': 'AER_AI',
+        'level': 'L2',
+        'group': '/PRODUCT',
+        'geolocation': '/PRODUCT',
+        'variable': 'aerosol_index_354_388',
+        'date_field': 'end',
+    },
+}
+
+# Level 1B radiance products of the spectrometer bands 1 to 8
+PRODUCTS.update({
+    'L1B_RA_BD{}'.format(band): {
+        'name': 'BD{}'.format(band),
+        'level': 'L1B',
+        'group': '/BAND{}_RADIANCE/STANDARD_MODE/OBSERVATIONS'.format(band),
+        'geolocation': '/BAND{}_RADIANCE/STANDARD_MODE/GEODATA'.format(band),
+        'variable': 'radiance',
+        'date_field': 'production',
+    } for band in range(1, 9)
+})
+
+# Processing options of process_file
+DEFAULT_OPTIONS = {
+    # Number of threads extracting the cities of L1B products
+    'threads': 1,
+    # 'swath' or 'image', see extract_city
+    'resampling': 'swath',
+    # 'geotiff' writes a file per city, 'netcdf' writes all cities of a granule into one file
+    'output_format': 'geotiff',
+    # GTiff creation options, see GeoTiffWriter
+    'creation_options': [],
+    # Maximum number of files waiting for the background writer, 0 writes the files immediately
+    'write_queue': 0,
+    # Approximate memory limit of the read band cube chunks in megabytes, None reads all bands at once
+    'max_memory': None,
+    # Skip the cities whose GeoTIFF file already exists, used when resuming an interrupted run
+    'skip_existing': False,
+}
+
+
+def regrid(latitudes, longitudes, values, n, method='bicubic'):
     """
-    Resamples input arrays to a (n, n)-sized array.
+    Resamples input arrays to a (n, n)-sized array. values can have a third, band axis, all bands are
+    resampled at once. Masks of the input arrays are kept, see resampling.resize.
 
     :param latitudes:
     :param longitudes:
     :param values:
     :param n:
+    :param method: Resampling method of values, see resampling.METHODS.
     :return:
     """
 
-    latitudes = np.array(Image.fromarray(latitudes).resize((n, n), Image.BILINEAR))
-    longitudes = np.array(Image.fromarray(longitudes).resize((n, n), Image.BILINEAR))
-    values = np.array(Image.fromarray(values).resize((n, n), Image.BICUBIC))
+    latitudes = resampling.resize(latitudes, n, 'bilinear')
+    longitudes = resampling.resize(longitudes, n, 'bilinear')
+    values = resampling.resize(values, n, method)
 
     return latitudes, longitudes, values
 
 
-def select_points(latitudes, longitudes, values, polygon_extent):
+def build_swath_index(latitudes, longitudes, block_size=16):
+    """
+    Builds a coarse index of the satellite swath. The swath is divided into (block_size, block_size) blocks
+    and the latitude and longitude ranges of every block are stored, so that pixel windows of the requested
+    extents can be found without scanning the whole swath.
+
+    :param latitudes: 2D array of pixel latitudes.
+    :param longitudes: 2D array of pixel longitudes.
+    :param block_size: Block edge length in pixels.
+    :return: Dictionary with the block ranges, the block size and the swath shape.
+    """
+
+    rows, cols = latitudes.shape
+    padding = ((0, -rows % block_size), (0, -cols % block_size))
+    block_rows = (rows + padding[0][1]) // block_size
+    block_cols = (cols + padding[1][1]) // block_size
+
+    def block_ranges(arr):
+        arr = np.ma.filled(np.ma.asarray(arr, dtype=np.float64), np.nan)
+        arr = np.pad(arr, padding, mode='constant', constant_values=np.nan)
+        arr = arr.reshape(block_rows, block_size, block_cols, block_size)
+        return np.fmin.reduce(arr, axis=(1, 3)), np.fmax.reduce(arr, axis=(1, 3))
+
+    min_lat, max_lat = block_ranges(latitudes)
+    min_lon, max_lon = block_ranges(longitudes)
+
+    swath_index = {
+        'min_lat': min_lat,
+        'max_lat': max_lat,
+        'min_lon': min_lon,
+        'max_lon': max_lon,
+        'block_size': block_size,
+        'shape': (rows, cols),
+    }
+    return swath_index
+
+
+def get_swath_window(swath_index, polygon_extent):
+    """
+    Finds the pixel window of the swath which covers the requested polygon_extent. Returns a (rows, cols)
+    tuple of slices or None if no block of the swath overlaps the extent.
+
+    :param swath_index: Swath index created by build_swath_index.
+    :param polygon_extent: Bounding box of the requested area.
+    :return:
+    """
+
+    overlap = (swath_index['max_lat'] > polygon_extent['min_lat']) \
+        & (swath_index['min_lat'] < polygon_extent['max_lat']) \
+        & (swath_index['max_lon'] > polygon_extent['min_lon']) \
+        & (swath_index['min_lon'] < polygon_extent['max_lon'])
+
+    block_rows = np.flatnonzero(overlap.any(axis=1))
+    if block_rows.size == 0:
+        return None
+    block_cols = np.flatnonzero(overlap.any(axis=0))
+
+    block_size = swath_index['block_size']
+    rows, cols = swath_index['shape']
+
+    window = (slice(block_rows[0] * block_size, min((block_rows[-1] + 1) * block_size, rows)),
+              slice(block_cols[0] * block_size, min((block_cols[-1] + 1) * block_size, cols)))
+    return window
+
+
+def select_points(latitudes, longitudes, values, polygon_extent, window=None):
     """
     Selects points which are inside of the requested polygon_extent. Returns arrays clipped to the extent.
+    If a pixel window is given, only the window is searched. values can have a third, band axis, the
+    selection is calculated once and applied to all bands. The returned arrays keep their own masks of
+    invalid cells, so they are left out when the arrays are resampled.
 
     :param latitudes:
     :param longitudes:
     :param values:
     :param polygon_extent:
+    :param window: Optional (rows, cols) tuple of slices, e.g. from get_swath_window.
     :return:
     """
 
-    def clip_masked_array(arr):
+    if window is not None:
+        latitudes = latitudes[window]
+        longitudes = longitudes[window]
+        values = values[window]
+
+    selected = np.logical_and(latitudes > polygon_extent['min_lat'], latitudes < polygon_extent['max_lat'])
+    selected &= np.logical_and(longitudes > polygon_extent['min_lon'], longitudes < polygon_extent['max_lon'])
+    selected = np.ma.filled(selected, False)
+
+    si, se = np.nonzero(selected)
+    if si.size > 4:
+        clip = (slice(si.min(), si.max() + 1), slice(se.min(), se.max() + 1))
+
+        latitudes = np.ma.copy(np.flip(np.ma.asarray(latitudes)[clip], axis=0))
+        longitudes = np.ma.copy(np.flip(np.ma.asarray(longitudes)[clip], axis=0))
+        values = np.ma.copy(np.flip(np.ma.asarray(values)[clip], axis=0))
+
+        return latitudes, longitudes, values
+    else:
+        return None, None, None
+
+
+def parse_filename(file):
+    """
+    Parses a Sentinel-5P file name, see FILENAME_PATTERN.
+
+    :param file: File name or path.
+    :return: Dictionary of the file name fields, or None if the name does not match.
+    """
+
+    match = FILENAME_PATTERN.match(os.path.basename(file))
+    if match is None:
+        return None
+    return match.groupdict()
+
+
+def get_filepath_sort_key(filepath, by_orbit=False):
+    """
+    Sort key grouping input files by product and ordering them by sensing start. With by_orbit the
+    files are ordered by orbit first, so the products of an orbit are processed one after another and
+    can reuse the grid neighbours of their shared geolocation, see get_neighbours_cache. Files with
+    unknown names are placed last.
+
+    :param filepath: Path to the input file.
+    :param by_orbit: Order the files by orbit before the product.
+    :return: Tuple.
+    """
+
+    file_attributes = parse_filename(filepath)
+    if file_attributes is None:
+        return 1, '', os.path.basename(filepath)
+    if by_orbit:
+        return 0, file_attributes['orbit'], file_attributes['start'], file_attributes['file_type']
+    return 0, file_attributes['file_type'], file_attributes['start']
+
+
+def get_geo_transform(bbox, shape):
+    """
+    Calculates the GDAL geotransform of a (rows, cols) grid over bbox.
+
+    :param bbox: Bounding box of the grid.
+    :param shape: Grid shape, only the first two axes are used.
+    :return: Geotransform tuple.
+    """
+
+    pixel_width = (bbox['max_lon'] - bbox['min_lon']) / shape[1]
+    pixel_height = (bbox['max_lat'] - bbox['min_lat']) / shape[0]
+
+    geo_transform = (bbox['min_lon'] - 0.5 * pixel_width,
+                     pixel_width,
+                     0,
+                     bbox['max_lat'] + 0.5 * pixel_height,
+                     0,
+                     -pixel_height
+                     )
+    return geo_transform
+
+
+class GeoTiffWriter:
+    """
+    Writes arrays as GeoTIFF files. The GDAL driver and the projection are created once and reused for
+    every file. With a positive queue_size the files are written by a background thread, write only
+    blocks when queue_size files are already waiting.
+
+    :param creation_options: List of GTiff creation options, e.g. ['COMPRESS=DEFLATE', 'PREDICTOR=3'].
+    :param queue_size: Maximum number of queued files, 0 writes the files immediately.
+    """
+
+    def __init__(self, creation_options=None, queue_size=0):
+        self.driver = gdal.GetDriverByName('GTiff')
+        self.creation_options = list(creation_options or [])
+
+        projection = osr.SpatialReference()
+        projection.ImportFromEPSG(4326)
+        self.projection_wkt = projection.ExportToWkt()
+
+        self.error = None
+        self.queue = None
+        self.thread = None
+        if queue_size > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, values, filename, bbox):
         """
-        Clips array to the unmasked cells. Returns clipped array.
+        Writes input array as a GeoTIFF file to disk. A (rows, cols, bands) array is written as
+        a multi-band GeoTIFF, masked cells are written as NaN.
 
-        :param arr:
-        :return:
+        :param values:
+        :param filename: Output path without an extension.
+        :param bbox: Bounding box of the array.
+        :return: None
         """
-        si, se = np.where(~arr.mask)
-        if si.size > 4:
-            arr = arr[si.min():si.max() + 1, se.min():se.max() + 1]
-            return arr
+
+        if self.queue is None:
+            self.write_file(values, filename, bbox)
         else:
-            return None
+            self.raise_error()
+            self.queue.put((values, filename, bbox))
+
+    def write_file(self, values, filename, bbox):
+        # The file is written under a temporary name and renamed when complete, so an interrupted run
+        # never leaves a truncated file under the final name
+        filename += '.tiff'
+        part_filename = filename + '.part'
+
+        values = np.ma.filled(values, np.nan)
+        if values.ndim == 2:
+            values = values[:, :, np.newaxis]
+
+        rows, cols, bands = values.shape
+        dataset = self.driver.Create(part_filename, cols, rows, bands, gdal.GDT_Float32, self.creation_options)
+
+        dataset.SetProjection(self.projection_wkt)
+        dataset.SetGeoTransform(get_geo_transform(bbox, values.shape))
+        for band in range(bands):
+            dataset.GetRasterBand(band + 1).SetNoDataValue(np.nan)
+            dataset.GetRasterBand(band + 1).WriteArray(values[:, :, band])
+
+        dataset.FlushCache()
+        dataset = None
+        os.replace(part_filename, filename)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self.write_file(*item)
+                except Exception as e:
+                    self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """
+        Waits until all queued files are written. Raises the first error of the background thread.
 
-    if type(values) == np.ndarray:
-        latitudes = np.ma.MaskedArray(latitudes)
-        longitudes = np.ma.MaskedArray(longitudes)
-        values = np.ma.MaskedArray(values)
+        :return: None
+        """
 
-    selected_latitudes = np.logical_and(latitudes > polygon_extent['min_lat'], latitudes < polygon_extent['max_lat'])
-    selected_longitudes = np.logical_and(longitudes > polygon_extent['min_lon'], longitudes < polygon_extent['max_lon'])
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
 
-    selected_latitudes_longitudes = np.logical_and(selected_latitudes, selected_longitudes)
-    selected_latitudes_longitudes = np.invert(np.asarray(selected_latitudes_longitudes))
+    def discard(self):
+        """
+        Stops the writer after a failed input file. The queued files are still written, the errors of
+        the background thread are dropped.
 
-    latitudes.mask = selected_latitudes_longitudes
-    longitudes.mask = selected_latitudes_longitudes
-    values.mask = selected_latitudes_longitudes
+        :return: None
+        """
 
-    latitudes = clip_masked_array(latitudes)
-    if latitudes is not None:
-        longitudes = clip_masked_array(longitudes)
-        values = clip_masked_array(values)
+        try:
+            self.close()
+        except Exception:
+            pass
 
-        latitudes = np.flip(latitudes, axis=0)
-        longitudes = np.flip(longitudes, axis=0)
-        values = np.flip(values, axis=0)
 
-        return np.ma.copy(latitudes), np.ma.copy(longitudes), np.ma.copy(values)
-    else:
-        return None, None, None
+class NetCDFCubeWriter:
+    """
+    Writes all city tiles of a granule into a single netCDF file. The tiles are stored in a
+    (city, band, y, x) variable chunked by city. Every city of the granule has a fixed index along the
+    city dimension, see set_cities, a city without a tile keeps NaN values. The tile names, city
+    metadata, bounding boxes and grid coordinates are stored as coordinate variables along the city
+    dimension. The file is created on the first write.
+
+    :param filename: Path to the output *.nc file.
+    :param source: Name of the input file, stored as a global attribute.
+    """
+
+    def __init__(self, filename, source=None):
+        self.filename = filename
+        self.source = source
+        self.cities = []
+        self.city_indices = {}
+        self.dataset = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def set_cities(self, cities):
+        """
+        Sets the cities of the granule, the index of a city along the city dimension is its position in
+        the list. Must be called before the first write.
+
+        :param cities: List of dictionaries with the 'tile' name, 'country', 'name_ascii', 'population'
+            and 'bbox' of the cities.
+        :return: None
+        """
+
+        self.cities = list(cities)
+        self.city_indices = {city['tile']: i for i, city in enumerate(self.cities)}
+
+    def create(self, shape):
+        rows, cols, bands = shape
+
+        cube_dir = os.path.dirname(self.filename)
+        if cube_dir and not os.path.exists(cube_dir):
+            os.makedirs(cube_dir)
+
+        dataset = nC.Dataset(self.filename + '.part', 'w')
+        if self.source is not None:
+            dataset.source = self.source
+        dataset.Conventions = 'CF-1.7'
+
+        dataset.createDimension('city', len(self.cities))
+        dataset.createDimension('band', bands)
+        dataset.createDimension('y', rows)
+        dataset.createDimension('x', cols)
+
+        for name in ('tile', 'country', 'name_ascii'):
+            dataset.createVariable(name, str, ('city',))[:] = np.array([city[name] for city in self.cities],
+                                                                        dtype=object)
+        dataset.createVariable('population', 'i8', ('city',))[:] = [city['population'] for city in self.cities]
+        for name in ('min_lon', 'min_lat', 'max_lon', 'max_lat'):
+            dataset.createVariable(name, 'f8', ('city',))[:] = [city['bbox'][name] for city in self.cities]
+
+        latitude = dataset.createVariable('latitude', 'f8', ('city', 'y'))
+        latitude.units = 'degrees_north'
+        longitude = dataset.createVariable('longitude', 'f8', ('city', 'x'))
+        longitude.units = 'degrees_east'
+        for i, city in enumerate(self.cities):
+            geo_transform = get_geo_transform(city['bbox'], shape)
+            latitude[i, :] = geo_transform[3] + (np.arange(rows) + 0.5) * geo_transform[5]
+            longitude[i, :] = geo_transform[0] + (np.arange(cols) + 0.5) * geo_transform[1]
+
+        values = dataset.createVariable('values', 'f4', ('city', 'band', 'y', 'x'), zlib=True,
+                                        chunksizes=(1, bands, rows, cols), fill_value=np.float32(np.nan))
+        values.coordinates = 'latitude longitude tile country name_ascii population'
+
+        self.dataset = dataset
+
+    def write(self, values, filename, bbox):
+        """
+        Writes the tile of a city at the index of the city, see set_cities.
+
+        :param values: (rows, cols) or (rows, cols, bands) array.
+        :param filename: Tile name, only the base name is used.
+        :param bbox: Bounding box of the tile, the bounding box given in set_cities is stored.
+        :return: None
+        """
+
+        values = np.ma.filled(values, np.nan)
+        if values.ndim == 2:
+            values = values[:, :, np.newaxis]
+
+        i = self.city_indices[os.path.basename(filename)]
+
+        with self.lock:
+            if self.dataset is None:
+                self.create(values.shape)
+
+            self.dataset['values'][i, :, :, :] = np.moveaxis(values, -1, 0)
+
+    def close(self):
+        """
+        Closes the file and moves it to its final name.
+
+        :return: None
+        """
+
+        if self.dataset is not None:
+            dataset, self.dataset = self.dataset, None
+            dataset.close()
+            os.replace(self.filename + '.part', self.filename)
+
+    def discard(self):
+        """
+        Closes and removes the partly written file of a failed input file.
+
+        :return: None
+        """
+
+        if self.dataset is not None:
+            dataset, self.dataset = self.dataset, None
+            try:
+                dataset.close()
+            except RuntimeError:
+                pass
+        if os.path.exists(self.filename + '.part'):
+            os.remove(self.filename + '.part')
+
+
+def get_cube_filename(output_dir, file):
+    """
+    Returns the path to the netCDF cube of an input file. The cubes are written to the netcdf
+    subdirectory and their names do not match FILENAME_PATTERN, so a cube is never taken for an
+    input file, even if the input and output directories are the same.
+
+    :param output_dir: Path to the output directory.
+    :param file: Name of the input file.
+    :return: Path to the *_cities.nc file.
+    """
+
+    return os.path.join(output_dir, 'netcdf', os.path.splitext(os.path.basename(file))[0] + '_cities.nc')
 
 
 def write_geotiff(values, filename, bbox):
     """
     Writes input array as a GeoTIFF file to disk. Requires latitudes and longitudes arrays to
-    calculate the georeference.
+    calculate the georeference. A (rows, cols, bands) array is written as a multi-band GeoTIFF.
+    Use a GeoTiffWriter when writing many files.
 
-    :param latitudes:
-    :param longitudes:
     :param values:
     :param filename:
+    :param bbox:
     :return:
     """
 
-    filename += '.tiff'
-    # real_bbox = {'max_lon': np.max(longitudes),
-    #              'min_lon': np.min(longitudes),
-    #              'max_lat': np.max(latitudes),
-    #              'min_lat': np.min(latitudes),
-    #              }
+    GeoTiffWriter().write(values, filename, bbox)
 
-    pixel_width = (bbox['max_lon'] - bbox['min_lon']) / values.shape[1]
-    pixel_height = (bbox['max_lat'] - bbox['min_lat']) / values.shape[0]
 
-    geo_transform = (bbox['min_lon'] - 0.5 * pixel_width,
-                     pixel_width,
-                     0,
-                     bbox['max_lat'] + 0.5 * pixel_height,
-                     0,
-                     -pixel_height
-                     )
+def get_point_columns(latitudes, longitudes, values):
+    """
+    Flattens the input arrays into columns of points. Points with masked coordinates or with all values
+    masked are skipped, remaining masked values are set to NaN.
+
+    :param latitudes:
+    :param longitudes:
+    :param values: (rows, cols) or (rows, cols, bands) array.
+    :return: (points, 2 + bands) float array of latitude, longitude and values columns.
+    """
+
+    values = np.ma.asarray(values)
+    values = values.reshape(values.shape[0] * values.shape[1], -1)
+    latitudes = np.ma.asarray(latitudes).ravel()
+    longitudes = np.ma.asarray(longitudes).ravel()
 
-    driver = gdal.GetDriverByName('GTiff')
-    rows, cols = values.shape
-    dataset = driver.Create(filename, cols, rows, 1, gdal.GDT_Float32)
+    valid = ~np.ma.getmaskarray(latitudes) & ~np.ma.getmaskarray(longitudes) & \
+        ~np.ma.getmaskarray(values).all(axis=1)
 
-    projection = osr.SpatialReference()
-    projection.ImportFromEPSG(4326)
-    projection_wkt = projection.ExportToWkt()
-    dataset.SetProjection(projection_wkt)
-    dataset.SetGeoTransform(geo_transform)
-    dataset.GetRasterBand(1).WriteArray(values)
-    # dataset = None
+    columns = np.column_stack((np.ma.getdata(latitudes)[valid],
+                               np.ma.getdata(longitudes)[valid],
+                               np.ma.filled(values.astype(np.float64), np.nan)[valid]))
+    return columns
 
 
-def write_csv(latitudes, longitudes, values, filename):
+def get_csv_format(dtype):
     """
-    Writes the input array as a CSV file to disk.
+    Returns the shortest printf format that round-trips the values of a column of the given type.
+
+    :param dtype: Type of the input array of the column.
+    :return: str
+    """
+
+    if np.dtype(dtype).itemsize <= 4:
+        return '%.9g'
+    return '%.17g'
+
+
+def write_csv(latitudes, longitudes, values, filename, compression=None, chunk_size=65536):
+    """
+    Writes the input array as a CSV file to disk. The points are formatted and written in chunks of
+    chunk_size rows, masked points are skipped. Every column is formatted with the precision of its input
+    type, see get_csv_format.
     :param latitudes:
     :param longitudes:
-    :param values:
+    :param values: (rows, cols) or (rows, cols, bands) array, every band is written as a column.
     :param filename:
+    :param compression: None or 'gzip'.
+    :param chunk_size: Number of rows formatted at once.
     :return:
     """
 
     filename += '.csv'
-    rows = zip(latitudes.ravel(), longitudes.ravel(), values.ravel())
+    columns = get_point_columns(latitudes, longitudes, values)
+    bands = columns.shape[1] - 2
+    row_format = ','.join([get_csv_format(np.asarray(latitudes).dtype), get_csv_format(np.asarray(longitudes).dtype)]
+                          + [get_csv_format(np.asarray(values).dtype)] * bands) + '\n'
+
+    if compression == 'gzip':
+        file = gzip.open(filename + '.gz', 'wt', encoding='utf-8')
+    else:
+        file = open(filename, 'w', encoding='utf-8')
 
-    with open(filename, 'w') as file:
-        writer = csv.writer(file)
-        for row in rows:
-            writer.writerow(row)
+    with file:
+        for start in range(0, columns.shape[0], chunk_size):
+            chunk = columns[start:start + chunk_size]
+            file.write((row_format * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
+
+def write_parquet(latitudes, longitudes, values, filename):
+    """
+    Writes the input array as a Parquet file to disk. Requires the pyarrow package.
+    :param latitudes:
+    :param longitudes:
+    :param values: (rows, cols) or (rows, cols, bands) array, every band is written as a column.
+    :param filename:
+    :return:
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    filename += '.parquet'
+    columns = get_point_columns(latitudes, longitudes, values)
+
+    names = ['latitude', 'longitude']
+    if columns.shape[1] == 3:
+        names.append('value')
+    else:
+        names += ['band_' + str(band) for band in range(columns.shape[1] - 2)]
+
+    table = pa.table({name: columns[:, i] for i, name in enumerate(names)})
+    pq.write_table(table, filename, compression='zstd')
 
 
 def write_png(values, filename):
@@ -166,21 +695,9 @@ def write_png(values, filename):
 
     filename += '.png'
 
-    def float_to_split_hex(float_variable):
-        hex_variable = hex(struct.unpack('<I', struct.pack('<f', float_variable))[0])
-        return hex_variable[2:6], hex_variable[6:10]
-
-    float_to_split_hex = np.vectorize(float_to_split_hex)
-    values = np.ma.filled(values, np.nan)
-    hex_array = float_to_split_hex(values)
-    hex_array = [hex_array[0].tolist(), hex_array[1].tolist()]
-    split_hex_array = []
-
-    for row, i in enumerate(hex_array[0]):
-        split_hex_array.append([])
-        for element, j in enumerate(hex_array[0][row]):
-            split_hex_array[row].append(int(hex_array[0][row][element], 16))
-            split_hex_array[row].append(int(hex_array[1][row][element], 16))
+    # The big-endian float32 bits are split into the high (grey) and low (alpha) 16-bit channels
+    values = np.ascontiguousarray(np.ma.filled(values, np.nan), dtype='>f4')
+    split_values = values.view('>u2').reshape(values.shape[0], values.shape[1] * 2)
 
     with open(filename, 'wb') as file:
         writer = png.Writer(width=values.shape[1],
@@ -188,7 +705,7 @@ def write_png(values, filename):
                             bitdepth=16,
                             greyscale=True,
                             alpha=True, )
-        writer.write(file, split_hex_array)
+        writer.write(file, split_values)
 
 
 def read_png(filename):
@@ -199,69 +716,1139 @@ def read_png(filename):
     """
     filename += '.png'
     reader = png.Reader(filename).asDirect()
-    values = []
 
-    for row in reader[2]:
-        z = list(zip(row[::2], row[1::2]))
+    split_values = np.vstack([np.asarray(row, dtype=np.uint16) for row in reader[2]]).astype('>u2')
+    values = split_values.view('>f4').astype(np.float32)
+    return values
+
 
-        new_row = []
-        for j in z:
-            unpacked = struct.unpack('>f', struct.pack('>HH', j[0], j[1]))[0]
-            new_row.append(unpacked)
-        values.append(row)
+def make_read_only(arr):
+    """
+    Marks the data and the mask of a masked array as read-only.
 
-    values = np.vstack(values)
-    return values
+    :param arr: Masked array.
+    :return: The same masked array.
+    """
 
+    arr.setflags(write=False)
+    if arr.mask is not np.ma.nomask:
+        arr.mask.setflags(write=False)
+    return arr
 
-def get_product_extent(nc_dataset):
+
+def read_variables(nc_group, variable_names):
     """
-    Calculates the product extent from the NetCDF metadata. Returns a GeoJSON polygon feature.
-    :param nc_dataset:
+    Reads the first time step of the requested variables from a NetCDF group. Every variable is decoded
+    only once, the returned arrays are read-only so they can be shared by all cities of the product.
+
+    :param nc_group: NetCDF dataset or group.
+    :param variable_names: List of variable names.
+    :return: Dictionary of read-only masked arrays.
+    """
+
+    variables = {}
+    for name in variable_names:
+        variables[name] = make_read_only(np.ma.asarray(nc_group.variables[name][0, ...]))
+    return variables
+
+
+def get_chunk_rows(variable):
+    """
+    Returns the number of scanlines in a HDF5 chunk of a (time, scanline, ...) variable.
+
+    :param variable: NetCDF variable.
     :return:
     """
-    nc_dataset_gml = nc_dataset[
-        'METADATA/EOP_METADATA/om:featureOfInterest/eop:multiExtentOf/gml:surfaceMembers/gml:exterior'
-    ]
 
-    nc_dataset_gml = getattr(nc_dataset_gml, 'gml:posList')
+    chunking = variable.chunking()
+    if chunking == 'contiguous':
+        return 1
+    return chunking[1]
 
-    nc_dataset_gml = nc_dataset_gml.split(' ')
-    nc_dataset_gml = [float(x) for x in nc_dataset_gml]
-    nc_dataset_gml = list(zip(nc_dataset_gml[1::2], nc_dataset_gml[::2]))
 
-    nc_dataset_gml[:] = [x for x in nc_dataset_gml if x[1] > 0]
+def get_row_spans(windows, chunk_rows, rows):
+    """
+    Merges the row ranges of pixel windows into spans of rows aligned to the chunks of a variable.
 
-    nc_dataset_geojson = {
-        'type': 'Polygon',
-        'coordinates': [
-            nc_dataset_gml
-        ]
-    }
+    :param windows: List of (rows, cols) tuples of slices, see get_swath_window.
+    :param chunk_rows: Number of rows in a chunk, see get_chunk_rows.
+    :param rows: Number of rows of the variable.
+    :return: Sorted list of row slices.
+    """
+
+    spans = []
+    for window in sorted(windows, key=lambda w: w[0].start):
+        span_start = window[0].start // chunk_rows * chunk_rows
+        span_stop = min(-(-window[0].stop // chunk_rows) * chunk_rows, rows)
+
+        if spans and span_start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], span_stop)
+        else:
+            spans.append([span_start, span_stop])
+
+    return [slice(span_start, span_stop) for span_start, span_stop in spans]
+
+
+def get_band_chunks(variable, rows, max_memory=None):
+    """
+    Splits the band axis of a (time, scanline, ground_pixel, band) variable into chunks, so that a chunk
+    of the given rows takes about max_memory bytes once read. The chunks are aligned to the HDF5 chunking
+    of the band axis.
+
+    :param variable: NetCDF variable.
+    :param rows: Row slice, see get_row_spans.
+    :param max_memory: Memory limit in bytes, None reads all bands at once.
+    :return: List of band slices.
+    """
+
+    if variable.ndim < 4 or not max_memory:
+        return [slice(None)]
+
+    bands = variable.shape[3]
+    # Data and mask of the read values, and the copy made while reading
+    band_bytes = 2 * (rows.stop - rows.start) * variable.shape[2] * (variable.dtype.itemsize + 1)
+    chunk_bands = max(1, int(max_memory // band_bytes))
+
+    chunking = variable.chunking()
+    if chunking != 'contiguous' and chunk_bands > chunking[3]:
+        chunk_bands = chunk_bands // chunking[3] * chunking[3]
+
+    return [slice(band, min(band + chunk_bands, bands)) for band in range(0, bands, chunk_bands)]
+
+
+def read_rows(variable, rows, bands=slice(None)):
+    """
+    Reads a span of rows of the first time step of a (time, scanline, ...) variable. Only the
+    chunks of the span are read and decompressed.
+
+    :param variable: NetCDF variable.
+    :param rows: Row slice, see get_row_spans.
+    :param bands: Band slice of a (time, scanline, ground_pixel, band) variable, see get_band_chunks.
+    :return: Read-only masked array.
+    """
+
+    if variable.ndim < 4:
+        return make_read_only(np.ma.asarray(variable[0, rows, ...]))
+    return make_read_only(np.ma.asarray(variable[0, rows, :, bands]))
 
-    nc_dataset_geojson = json.dumps(nc_dataset_geojson)
-    nc_dataset_extent = ogr.CreateGeometryFromJson(nc_dataset_geojson)
-    return nc_dataset_extent
 
+def reset_peak_memory():
+    """
+    Resets the peak resident set size of the process, so get_peak_memory returns the peak since the
+    reset. Only supported on Linux.
 
-def get_polygon_extent(polygon_coordinates):
+    :return: True if the peak was reset.
     """
-    Calculates a bounding box from a list of coordinates.
 
-    :param polygon_coordinates:
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_memory():
+    """
+    Returns the peak resident set size of the process in megabytes. On Linux this is the peak since the
+    last reset_peak_memory, elsewhere the peak of the whole process lifetime. Returns None where the
+    resource module is not available either.
+
     :return:
     """
 
-    polygon_bbox = {
-        'max_lat': max(polygon_coordinates, key=itemgetter(1))[1],
-        'min_lat': min(polygon_coordinates, key=itemgetter(1))[1],
-        'max_lon': max(polygon_coordinates, key=itemgetter(0))[0],
-        'min_lon': min(polygon_coordinates, key=itemgetter(0))[0],
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak_memory / 2 ** 20
+    return peak_memory / 2 ** 10
+
+
+def parse_pos_list(pos_list):
+    """
+    Parses a GML posList of 'lat lon lat lon ...' coordinates.
+
+    :param pos_list: str
+    :return: (n, 2) float64 array of (lon, lat) points.
+    """
+
+    return np.array(pos_list.split(), dtype=np.float64).reshape(-1, 2)[:, ::-1]
+
+
+def get_footprint_geometry(points):
+    """
+    Creates the footprint geometry from the outline points. The longitudes are unwrapped along the
+    outline, so an outline crossing the antimeridian is split into parts on both sides of it. An outline
+    going around a pole is closed over the pole.
+
+    :param points: (n, 2) array of (lon, lat) points, see parse_pos_list.
+    :return: OGR polygon or multipolygon.
+    """
+
+    if not np.array_equal(points[0], points[-1]):
+        points = np.vstack((points, points[:1]))
+
+    longitudes = np.empty(len(points))
+    longitudes[0] = points[0, 0]
+    longitudes[1:] = points[0, 0] + np.cumsum((np.diff(points[:, 0]) + 180.0) % 360.0 - 180.0)
+    # The last point is the first point shifted by the number of turns around the pole
+    longitudes[-1] = longitudes[0] + np.round((longitudes[-1] - longitudes[0]) / 360.0) * 360.0
+    ring = np.column_stack((longitudes, points[:, 1]))
+
+    if longitudes[-1] != longitudes[0]:
+        pole = np.copysign(90.0, points[np.argmax(np.abs(points[:, 1])), 1])
+        ring = np.vstack((ring, [[longitudes[-1], pole], [longitudes[0], pole], ring[0]]))
+
+    footprint = ogr.CreateGeometryFromWkb(cities_catalog.get_polygon_wkb(ring))
+    if not footprint.IsValid():
+        footprint = footprint.Buffer(0)
+
+    if longitudes.min() >= -180.0 and longitudes.max() <= 180.0:
+        return footprint
+
+    world = ogr.CreateGeometryFromWkb(cities_catalog.get_polygon_wkb(WORLD_RING))
+    parts = None
+    for shift in (-360.0, 0.0, 360.0):
+        part = ogr.CreateGeometryFromWkb(cities_catalog.get_polygon_wkb(ring + (shift, 0.0)))
+        if not part.IsValid():
+            part = part.Buffer(0)
+        part = part.Intersection(world)
+        if not part.IsEmpty():
+            parts = part if parts is None else parts.Union(part)
+
+    return parts
+
+
+def get_product_extent(nc_dataset):
+    """
+    Calculates the product extent from the footprint in the NetCDF metadata.
+
+    :param nc_dataset: NetCDF dataset.
+    :return: OGR polygon or multipolygon, see get_footprint_geometry.
+    """
+
+    nc_dataset_gml = nc_dataset[FOOTPRINT_GROUP]
+    return get_footprint_geometry(parse_pos_list(getattr(nc_dataset_gml, 'gml:posList')))
+
+
+# WKB footprints of the last FOOTPRINT_CACHE_SIZE input files, see get_file_extent
+footprint_cache = OrderedDict()
+FOOTPRINT_CACHE_SIZE = 1024
+
+
+def get_file_extent(filepath, nc_dataset=None):
+    """
+    Returns the product extent of an input file. The footprints are cached by the file path, size and
+    modification time, so the extent of a file is calculated once, e.g. when the input files are
+    filtered before processing.
+
+    :param filepath: Path to the input *.nc file.
+    :param nc_dataset: Optional open dataset of the file. The file is opened if the footprint is not
+        cached yet and no dataset is given, only the metadata attribute is read.
+    :return: OGR geometry, see get_product_extent.
+    """
+
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+
+    if key not in footprint_cache:
+        if nc_dataset is None:
+            with nC.Dataset(filepath, 'r') as nc_dataset:
+                extent = get_product_extent(nc_dataset)
+        else:
+            extent = get_product_extent(nc_dataset)
+        footprint_cache[key] = bytes(extent.ExportToWkb())
+        while len(footprint_cache) > FOOTPRINT_CACHE_SIZE:
+            footprint_cache.popitem(last=False)
+        return extent
+
+    footprint_cache.move_to_end(key)
+    return ogr.CreateGeometryFromWkb(footprint_cache[key])
+
+
+def build_cities_index(catalog):
+    """
+    Builds a spatial index of the city areas. The index keeps the city bounding boxes as an array sorted
+    by the minimum longitude, so that a query only has to compare the boxes which start west of the
+    queried extent. The city geometries are created from the catalog WKB when a city is first tested
+    and reused for every queried product.
+
+    :param catalog: Structured array of the cities, see cities_catalog.create_catalog.
+    :return: Dictionary with the catalog, bounding boxes and OGR geometries.
+    """
+
+    extents = np.column_stack((catalog['min_lon'], catalog['min_lat'], catalog['max_lon'], catalog['max_lat']))
+    order = np.argsort(extents[:, 0], kind='stable')
+
+    cities_index = {
+        'catalog': catalog,
+        'extents': extents,
+        'geometries': {},
+        'bboxes': extents[order],
+        'order': order,
+    }
+    return cities_index
+
+
+def load_cities_index(cities_filename):
+    """
+    Loads the city areas and builds the spatial index. A *.npy catalog written by cities_list.py is
+    memory-mapped, a GeoJSON file is converted to a catalog first.
+
+    :param cities_filename: Path to the city areas catalog or GeoJSON file.
+    :return: Spatial index, see build_cities_index.
+    """
+
+    if cities_filename.endswith('.npy'):
+        return build_cities_index(cities_catalog.read_catalog(cities_filename))
+
+    with open(cities_filename, encoding='utf-8') as f:
+        return build_cities_index(cities_catalog.create_catalog(json.load(f)))
+
+
+def get_cities_filename(catalog_filename='cities_areas.npy', geojson_filename='cities_areas.json'):
+    """
+    Returns the city areas file to load. The binary catalog built from the GeoJSON file by cities_catalog.py
+    or cities_list.generate_bounding_boxes is preferred, unless the GeoJSON file was modified after the
+    catalog was written, e.g. edited by hand or regenerated separately.
+
+    :param catalog_filename: Path to the city areas catalog.
+    :param geojson_filename: Path to the city areas GeoJSON file.
+    :return: Path to the file, see load_cities_index.
+    """
+
+    if not os.path.exists(catalog_filename):
+        return geojson_filename
+
+    if os.path.exists(geojson_filename) and os.path.getmtime(geojson_filename) > os.path.getmtime(catalog_filename):
+        print('Warning: {} is older than {}, the GeoJSON file is used. Run "python cities_catalog.py {} '
+              '--output {}" to update the catalog.'.format(catalog_filename, geojson_filename, geojson_filename,
+                                                           catalog_filename))
+        return geojson_filename
+
+    return catalog_filename
+
+
+def get_city_extent(cities_index, city_index):
+    """
+    Returns the bounding box of a city.
+
+    :param cities_index: Spatial index created by build_cities_index.
+    :param city_index: Index of the city in the catalog.
+    :return: Dictionary with the min_lon, min_lat, max_lon and max_lat of the city.
+    """
+
+    min_lon, min_lat, max_lon, max_lat = cities_index['extents'][city_index].tolist()
+    return {
+        'max_lat': max_lat,
+        'min_lat': min_lat,
+        'max_lon': max_lon,
+        'min_lon': min_lon,
+    }
+
+
+def get_city_geometry(cities_index, city_index):
+    """
+    Returns the OGR geometry of a city, creating it from the catalog WKB on first use.
+
+    :param cities_index: Spatial index created by build_cities_index.
+    :param city_index: Index of the city in the catalog.
+    :return: OGR polygon.
+    """
+
+    geometries = cities_index['geometries']
+    if city_index not in geometries:
+        geometries[city_index] = ogr.CreateGeometryFromWkb(cities_index['catalog'][city_index]['wkb'].tobytes())
+    return geometries[city_index]
+
+
+def query_cities_index(cities_index, extent):
+    """
+    Finds the cities which intersect the requested extent. Candidates are preselected by comparing
+    bounding boxes, the exact intersection test is done only for the candidates.
+
+    :param cities_index: Spatial index created by build_cities_index.
+    :param extent: OGR geometry, e.g. a satellite product extent.
+    :return: Sorted list of indices of the intersecting cities.
+    """
+
+    min_lon, max_lon, min_lat, max_lat = extent.GetEnvelope()
+    bboxes = cities_index['bboxes']
+
+    stop = np.searchsorted(bboxes[:, 0], max_lon, side='right')
+    candidates = bboxes[:stop]
+    overlap = (candidates[:, 2] >= min_lon) & (candidates[:, 1] <= max_lat) & (candidates[:, 3] >= min_lat)
+
+    prepared_extent = extent.CreatePreparedGeometry() if hasattr(extent, 'CreatePreparedGeometry') else extent
+
+    cities_in_extent = []
+    for i in cities_index['order'][:stop][overlap]:
+        if prepared_extent.Intersects(get_city_geometry(cities_index, int(i))):
+            cities_in_extent.append(int(i))
+
+    return sorted(cities_in_extent)
+
+
+# Neighbours of the city grids by granule geolocation, see get_neighbours_cache
+neighbours_caches = OrderedDict()
+
+
+def get_neighbours_cache(latitudes, longitudes, size=4):
+    """
+    Returns a dictionary caching the grid neighbours of the cities for the geolocation of a granule.
+    The cache is keyed by a digest of the geolocation arrays, so the products of an orbit sharing the
+    geolocation reuse the neighbours when they are processed one after another by the same process,
+    see get_filepath_sort_key. Only the caches of the last size granules are kept.
+
+    :param latitudes: 2D array of the pixel latitudes of the granule.
+    :param longitudes: 2D array of the pixel longitudes of the granule.
+    :param size: Number of kept caches.
+    :return: Dictionary of (city index, pixel window bounds) -> neighbours, see get_span_neighbours.
+    """
+
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(np.ma.getdata(latitudes)).tobytes())
+    digest.update(np.ascontiguousarray(np.ma.getdata(longitudes)).tobytes())
+    key = (latitudes.shape, digest.hexdigest())
+
+    if key in neighbours_caches:
+        neighbours_caches.move_to_end(key)
+    else:
+        neighbours_caches[key] = {}
+        while len(neighbours_caches) > size:
+            neighbours_caches.popitem(last=False)
+
+    return neighbours_caches[key]
+
+
+def get_city_neighbours(neighbours_cache, key, latitudes, longitudes, bbox, window):
+    """
+    Returns the neighbours of the (30, 30) city grid, calculating them if they are not cached yet.
+
+    :param neighbours_cache: Dictionary returned by get_neighbours_cache.
+    :param key: Cache key of the city, see get_span_neighbours.
+    :param latitudes: 2D array of pixel latitudes.
+    :param longitudes: 2D array of pixel longitudes.
+    :param bbox: City bounding box.
+    :param window: Pixel window around the city, see get_swath_window.
+    :return: See resampling.swath_neighbours.
+    """
+
+    if key not in neighbours_cache:
+        neighbours_cache[key] = resampling.swath_neighbours(latitudes, longitudes, bbox, 30, window)
+    return neighbours_cache[key]
+
+
+def get_span_neighbours(neighbours_cache, city_index, latitudes, longitudes, bbox, window, span):
+    """
+    Returns the neighbours of the (30, 30) city grid for values read from a span of rows. The neighbours
+    are calculated on the geolocation of the whole granule and cached by the city and its pixel window,
+    so they do not depend on the row spans, which follow the chunking of the data variable.
+
+    :param neighbours_cache: Dictionary returned by get_neighbours_cache.
+    :param city_index: Index of the city in the cities index.
+    :param latitudes: 2D array of the pixel latitudes of the granule.
+    :param longitudes: 2D array of the pixel longitudes of the granule.
+    :param bbox: City bounding box.
+    :param window: Pixel window around the city in the granule, see get_swath_window.
+    :param span: Row slice of the values, see get_row_spans.
+    :return: See resampling.swath_neighbours, the window is relative to the span.
+    """
+
+    key = (city_index, window[0].start, window[0].stop, window[1].start, window[1].stop)
+    neighbours = get_city_neighbours(neighbours_cache, key, latitudes, longitudes, bbox, window)
+    if neighbours is None:
+        return None
+
+    rows, cols = neighbours['window']
+    return dict(neighbours, window=(slice(rows.start - span.start, rows.stop - span.start), cols))
+
+
+def resample_city(latitudes, longitudes, values, window, requested_big_bbox, requested_small_bbox, neighbours=None,
+                  timer=None):
+    """
+    Resamples the city area of the swath to a (30, 30) grid. If neighbours are given, the swath pixels
+    are mapped straight onto the grid. Otherwise the area is clipped and regridded twice, treating the
+    swath as a regular image.
+
+    :param latitudes:
+    :param longitudes:
+    :param values: (rows, cols) or (rows, cols, bands) array.
+    :param window: Pixel window of requested_big_bbox, see get_swath_window.
+    :param requested_big_bbox: City bounding box with a margin used for the first clip.
+    :param requested_small_bbox: City bounding box.
+    :param neighbours: Optional grid neighbours, see get_city_neighbours.
+    :param timer: Optional metrics.StageTimer recording the 'select', 'regrid' and 'apply_neighbours' stages.
+    :return: (30, 30) or (30, 30, bands) masked array, or None if the swath does not cover the city.
+    """
+
+    if timer is None:
+        timer = metrics.StageTimer()
+
+    if neighbours is not None:
+        with timer.stage('apply_neighbours') as record:
+            svals = resampling.apply_neighbours(values, neighbours)
+            record['bytes'] = svals.nbytes
+        return svals
+
+    with timer.stage('select') as record:
+        slats, slons, svals = select_points(latitudes, longitudes, values, requested_big_bbox, window)
+
+    if svals is not None:
+        record['bytes'] = svals.nbytes
+        with timer.stage('regrid') as record:
+            slats, slons, svals = regrid(slats, slons, svals, 100)
+            record['bytes'] = svals.nbytes
+        with timer.stage('select') as record:
+            slats, slons, svals = select_points(slats, slons, svals, requested_small_bbox)
+
+    if svals is not None:
+        record['bytes'] = svals.nbytes
+        with timer.stage('regrid') as record:
+            slats, slons, svals = regrid(slats, slons, svals, 30)
+            record['bytes'] = svals.nbytes
+
+    return svals
+
+
+def extract_city(latitudes, longitudes, values, window, requested_big_bbox, requested_small_bbox, output_filename,
+                 writer, neighbours=None, timer=None):
+    """
+    Resamples the city area of the swath to a (30, 30) grid and writes it to disk, see resample_city.
+    For a (rows, cols, bands) values array all bands are written to a single multi-band file.
+
+    :param latitudes:
+    :param longitudes:
+    :param values:
+    :param window: Pixel window of requested_big_bbox, see get_swath_window.
+    :param requested_big_bbox: City bounding box with a margin used for the first clip.
+    :param requested_small_bbox: City bounding box.
+    :param output_filename: Output path without an extension.
+    :param writer: GeoTiffWriter or NetCDFCubeWriter writing the output.
+    :param neighbours: Optional grid neighbours, see get_city_neighbours.
+    :param timer: Optional metrics.StageTimer, see resample_city. Also records the 'write' stage.
+    :return: True if the tile was written, False if the swath does not cover the city.
+    """
+
+    if timer is None:
+        timer = metrics.StageTimer()
+
+    svals = resample_city(latitudes, longitudes, values, window, requested_big_bbox, requested_small_bbox,
+                          neighbours, timer)
+
+    if svals is not None:
+        # write_csv(slats, slons, svals, output_filename)
+        with timer.stage('write') as record:
+            writer.write(svals, output_filename, requested_small_bbox)
+            record['bytes'] = svals.nbytes
+        # write_png(svals, output_filename)
+
+    return svals is not None
+
+
+def get_city_windows(swath_index, cities_index, cities_in_file):
+    """
+    Finds the bounding boxes and the swath pixel windows of the cities.
+
+    :param swath_index: Swath index created by build_swath_index.
+    :param cities_index: Spatial index created by build_cities_index.
+    :param cities_in_file: List of city indices, see query_cities_index.
+    :return: Dictionary of city index -> (requested_small_bbox, requested_big_bbox, window) for the cities
+        covered by the swath.
+    """
+
+    city_windows = {}
+    for city_index in cities_in_file:
+        requested_small_bbox = get_city_extent(cities_index, city_index)
+        requested_big_bbox = requested_small_bbox.copy()
+
+        requested_big_bbox['min_lat'] -= 0.5
+        requested_big_bbox['max_lat'] += 0.5
+        requested_big_bbox['min_lon'] -= 0.5
+        requested_big_bbox['max_lon'] += 0.5
+
+        window = get_swath_window(swath_index, requested_big_bbox)
+        if window is not None:
+            city_windows[city_index] = (requested_small_bbox, requested_big_bbox, window)
+
+    return city_windows
+
+
+def get_output_filename(city, output_file_attributes):
+    """
+    Returns the name of the output file of a city without an extension.
+
+    :param city: Catalog record of the city, see cities_catalog.create_catalog.
+    :param output_file_attributes: Dictionary with the platform, product type and sensing date.
+    :return: str
+    """
+
+    output_filename = str(city['country']) \
+        + '_' + str(city['name_ascii']) \
+        + '_' + str(output_file_attributes['platform']) \
+        + '_' + str(output_file_attributes['product_type']) \
+        + '_' + str(output_file_attributes['sensing_date'])
+    return output_filename
+
+
+def extract_cities(variable, latitudes, longitudes, city_windows, cities_index, output_file_attributes, output_dir,
+                   writer, options, timer, neighbours_cache=None):
+    """
+    Extracts the cities from a data variable. Only the spans of rows covering the city windows are read
+    from the file. With a max_memory option a band cube is read in band chunks, the resampled chunks of
+    every city are collected in a tile buffer and written after the last chunk.
+    The tile buffers are reused by the cities of the next spans, unless the files are written by a
+    background writer which may still hold them.
+    The cities are extracted by a thread pool sharing the read values, the number of submitted cities is
+    bounded to limit the memory held by pending outputs. The grid neighbours of the 'swath' resampling
+    are calculated by the thread pool as well. With a skip_existing option the cities whose
+    GeoTIFF file already exists are not extracted again.
+
+    :param variable: NetCDF (time, scanline, ground_pixel[, band]) variable.
+    :param latitudes: 2D array of pixel latitudes.
+    :param longitudes: 2D array of pixel longitudes.
+    :param city_windows: Dictionary returned by get_city_windows.
+    :param cities_index: Spatial index created by build_cities_index.
+    :param output_file_attributes: Dictionary with the platform, product type and sensing date.
+    :param output_dir: Path to the output directory.
+    :param writer: GeoTiffWriter or NetCDFCubeWriter writing the output.
+    :param options: Dictionary of processing options, see DEFAULT_OPTIONS.
+    :param timer: metrics.StageTimer recording the stages of every city and band chunk.
+    :param neighbours_cache: Dictionary returned by get_neighbours_cache, required by the 'swath' resampling.
+    :return: List of the names of the written output files.
+    """
+
+    outputs = []
+
+    # The netCDF cube writer stores only the base names, see NetCDFCubeWriter.write
+    product_dir = os.path.join(output_dir, output_file_attributes['product_type'])
+    if options['output_format'] == 'geotiff' and not os.path.exists(product_dir):
+        os.makedirs(product_dir)
+
+    if options['output_format'] == 'netcdf':
+        cities = []
+        for city_index, (requested_small_bbox, _, _) in city_windows.items():
+            city = cities_index['catalog'][city_index]
+            cities.append({
+                'tile': get_output_filename(city, output_file_attributes),
+                'country': str(city['country']),
+                'name_ascii': str(city['name_ascii']),
+                'population': int(city['population']),
+                'bbox': requested_small_bbox,
+            })
+        writer.set_cities(cities)
+
+    spans = get_row_spans([window for _, _, window in city_windows.values()],
+                          get_chunk_rows(variable), latitudes.shape[0])
+
+    max_memory = options['max_memory'] * 2 ** 20 if options['max_memory'] else None
+    max_pending = 4 * options['threads']
+    scratch_tiles = []
+
+    with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+        for span in spans:
+            lats = latitudes[span]
+            lons = longitudes[span]
+
+            def extract(span_city, vals, city_timer, write):
+                city_index, requested_small_bbox, requested_big_bbox, window, span_window, _, output_path = span_city
+
+                neighbours = None
+                if options['resampling'] == 'swath':
+                    with city_timer.stage('neighbours'):
+                        neighbours = get_span_neighbours(neighbours_cache, city_index, latitudes, longitudes,
+                                                         requested_small_bbox, window, span)
+                    if neighbours is None:
+                        return None
+
+                if write:
+                    return extract_city(lats, lons, vals, span_window, requested_big_bbox, requested_small_bbox,
+                                        output_path, writer, neighbours, city_timer)
+                return resample_city(lats, lons, vals, span_window, requested_big_bbox, requested_small_bbox,
+                                     neighbours, city_timer)
+
+            span_cities = []
+            for city_index, (requested_small_bbox, requested_big_bbox, window) in city_windows.items():
+                if window[0].start < span.start or window[0].stop > span.stop:
+                    continue
+                span_window = (slice(window[0].start - span.start, window[0].stop - span.start), window[1])
+
+                city = cities_index['catalog'][city_index]
+                city_timer = timer.labelled(city=str(city['country']) + '_' + str(city['name_ascii']))
+
+                output_filename = get_output_filename(city, output_file_attributes)
+                output_path = os.path.join(product_dir, output_filename)
+                if options['skip_existing'] and options['output_format'] == 'geotiff' \
+                        and os.path.exists(output_path + '.tiff'):
+                    outputs.append(output_filename)
+                    continue
+
+                span_cities.append(((city_index, requested_small_bbox, requested_big_bbox, window, span_window,
+                                     output_filename, output_path), city_timer))
+
+            band_chunks = get_band_chunks(variable, span, max_memory)
+            tiles = {}
+            # Cities whose tile was written, a city not covered by the swath has no tile
+            written = set()
+
+            for band_chunk in band_chunks:
+                bands = None
+                if len(band_chunks) > 1:
+                    bands = '{}:{}'.format(band_chunk.start, band_chunk.stop)
+
+                with timer.labelled(bands=bands).stage('read') as record:
+                    vals = read_rows(variable, span, band_chunk)
+                    record['bytes'] = vals.nbytes
+                pending = {}
+
+                def finish(future):
+                    city_index = pending.pop(future)
+                    svals = future.result()
+                    if len(band_chunks) == 1:
+                        if svals:
+                            written.add(city_index)
+                    elif svals is not None:
+                        if city_index not in tiles:
+                            if scratch_tiles:
+                                tiles[city_index] = scratch_tiles.pop()
+                                tiles[city_index][...] = np.ma.masked
+                            else:
+                                tiles[city_index] = np.ma.masked_all(svals.shape[:2] + (variable.shape[3],),
+                                                                     dtype=np.float32)
+                        tiles[city_index][:, :, band_chunk] = svals
+
+                for span_city, city_timer in span_cities:
+                    if len(pending) >= max_pending:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            finish(future)
+
+                    future = executor.submit(extract, span_city, vals, city_timer.labelled(bands=bands),
+                                             len(band_chunks) == 1)
+                    pending[future] = span_city[0]
+
+                for future in list(pending):
+                    finish(future)
+
+                del vals
+
+            for (city_index, requested_small_bbox, _, _, _, output_filename, output_path), city_timer in span_cities:
+                if city_index in tiles:
+                    with city_timer.stage('write') as record:
+                        tile = tiles.pop(city_index)
+                        writer.write(tile, output_path, requested_small_bbox)
+                        record['bytes'] = tile.nbytes
+                    written.add(city_index)
+                    if not options['write_queue']:
+                        scratch_tiles.append(tile)
+
+                if city_index in written:
+                    outputs.append(output_filename)
+
+    return outputs
+
+
+def process_file(filepath, cities_index, output_dir, options=None):
+    """
+    Extracts the city areas from a single Sentinel-5P product and writes them to the output directory.
+
+    :param filepath: Path to the input *.nc file.
+    :param cities_index: Spatial index created by build_cities_index.
+    :param output_dir: Path to the output directory.
+    :param options: Dictionary of processing options, see DEFAULT_OPTIONS.
+    :return: Dictionary with the file name, list of written output files, errors, elapsed time, peak
+        memory and its scope, see get_peak_memory, and the stage records, see metrics.StageTimer.
+    """
+
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+
+    start = time.time()
+    peak_memory_reset = reset_peak_memory()
+    timer = metrics.StageTimer()
+    file = os.path.basename(filepath)
+    result = {
+        'file': file,
+        'outputs': [],
+        'errors': [],
     }
-    return polygon_bbox
+
+    file_attributes = parse_filename(file)
+    product = PRODUCTS.get(file_attributes['file_type']) if file_attributes else None
+
+    cube_filename = get_cube_filename(output_dir, file)
+
+    if file_attributes is None:
+        result['errors'].append('Unknown file name: ' + file)
+    elif product is None:
+        result['errors'].append('Unknown product type: ' + file_attributes['file_type'])
+    elif options['output_format'] == 'netcdf' and os.path.realpath(cube_filename) == os.path.realpath(filepath):
+        result['errors'].append('Output file is the input file: ' + cube_filename)
+    else:
+        output_file_attributes = {
+            'platform': file_attributes['platform'],
+            'level': product['level'],
+            'product_type': product['name'],
+            'sensing_date': file_attributes[product['date_field']],
+        }
+
+        if options['output_format'] == 'netcdf':
+            writer = NetCDFCubeWriter(cube_filename, file)
+        else:
+            writer = GeoTiffWriter(options['creation_options'], options['write_queue'])
+
+        # A damaged or truncated file fails only itself, the error is returned in the result
+        ds = None
+        try:
+            with timer.stage('open') as record:
+                ds = nC.Dataset(filepath, 'r')
+                record['bytes'] = os.path.getsize(filepath)
+
+            with timer.stage('extent'):
+                satellite_product_extent = get_file_extent(filepath, ds)
+                cities_in_file = query_cities_index(cities_index, satellite_product_extent)
+
+            if cities_in_file:
+                with timer.stage('read_geolocation') as record:
+                    geodata = read_variables(ds[product['geolocation']], ['latitude', 'longitude'])
+                    lats = geodata['latitude']
+                    lons = geodata['longitude']
+                    record['bytes'] = lats.nbytes + lons.nbytes
+
+                with timer.stage('swath_index'):
+                    swath_index = build_swath_index(lats, lons)
+                    city_windows = get_city_windows(swath_index, cities_index, cities_in_file)
+
+                neighbours_cache = None
+                if options['resampling'] == 'swath':
+                    with timer.stage('neighbours_cache'):
+                        neighbours_cache = get_neighbours_cache(lats, lons)
+
+                result['outputs'] = extract_cities(ds[product['group']].variables[product['variable']], lats, lons,
+                                                   city_windows, cities_index, output_file_attributes, output_dir,
+                                                   writer, options, timer, neighbours_cache)
+
+            with timer.stage('close'):
+                writer.close()
+                ds.close()
+        except Exception as e:
+            result['errors'].append('Processing failed: {}: {}'.format(type(e).__name__, e))
+            writer.discard()
+            if ds is not None and ds.isopen():
+                ds.close()
+
+    result['elapsed'] = time.time() - start
+    result['peak_memory'] = get_peak_memory()
+    # 'file' if the peak was measured for this file, 'process' for the peak of the whole process
+    result['peak_memory_scope'] = 'file' if peak_memory_reset else 'process'
+    result['stages'] = timer.records
+    return result
+
+
+# Cities index of a worker process, see init_worker
+worker_cities_index = None
+
+
+def init_worker(cities_filename):
+    """
+    Loads the cities list and builds the spatial index in a worker process. OGR geometries
+    can not be pickled, so every worker builds its own index once.
+
+    :param cities_filename: Path to the city areas catalog or GeoJSON file, see load_cities_index.
+    :return: None
+    """
+
+    global worker_cities_index
+
+    worker_cities_index = load_cities_index(cities_filename)
+
+
+def process_file_in_worker(filepath, output_dir, options):
+    """
+    Runs process_file with the cities index of the worker process.
+
+    :param filepath: Path to the input *.nc file.
+    :param output_dir: Path to the output directory.
+    :param options: See process_file.
+    :return: See process_file.
+    """
+
+    return process_file(filepath, worker_cities_index, output_dir, options)
+
+
+def get_error_result(filepath, error):
+    """
+    Returns the result of an input file whose processing raised an error, e.g. in a crashed worker process.
+
+    :param filepath: Path to the input file.
+    :param error: Raised exception.
+    :return: Dictionary like the result of process_file.
+    """
+
+    result = {
+        'file': os.path.basename(filepath),
+        'outputs': [],
+        'errors': ['Processing failed: {}: {}'.format(type(error).__name__, error)],
+        'elapsed': 0.0,
+        'peak_memory': None,
+        'peak_memory_scope': 'process',
+        'stages': [],
+    }
+    return result
+
+
+def print_result(result, start):
+    """
+    Prints the outputs and timing of a processed file.
+
+    :param result: Dictionary returned by process_file.
+    :param start: Start time of the whole run.
+    :return: None
+    """
+
+    for output_filename in result['outputs']:
+        print(output_filename)
+    for error in result['errors']:
+        print(error)
+
+    partial_elapsed = (time.time() - start)
+    print('File:', result['file'])
+    print('File elapsed time:', str(timedelta(seconds=result['elapsed'])))
+    if result['peak_memory'] is not None:
+        label = 'Peak memory' if result['peak_memory_scope'] == 'file' else 'Process peak memory'
+        print('{}: {:.1f} MB'.format(label, result['peak_memory']))
+    for stage, total in metrics.summarize(result['stages']).items():
+        print('Stage {}: {} x, {:.3f} s, {:.1f} MB'.format(stage, total['count'], total['seconds'],
+                                                          total['bytes'] / 2 ** 20))
+    print('Partial elapsed time:', str(timedelta(seconds=partial_elapsed)))
+    # print('\033[92mPartial elapsed time:\033[0m', str(timedelta(seconds=partial_elapsed)))
+
+
+def parse_arguments():
+    """
+    Parses the command line arguments.
+
+    :return: argparse.Namespace with the parsed arguments.
+    """
+
+    parser = argparse.ArgumentParser(description='Extracts city areas from Sentinel-5P products.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes. Every input file is processed by a single worker. '
+                             'The grid neighbours of the swath resampling are cached by every worker on its own.')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Number of threads per worker extracting the cities of L1B products.')
+    parser.add_argument('--resampling', choices=['swath', 'image'], default='swath',
+                        help="'swath' maps the swath pixels straight onto the city grids, "
+                             "'image' clips and regrids the swath twice as a regular image.")
+    parser.add_argument('--output-format', choices=['geotiff', 'netcdf'], default='geotiff',
+                        help="'geotiff' writes a file per city, 'netcdf' writes all cities of an input file "
+                             "into a single (city, band, y, x) netCDF file netcdf/<input name>_cities.nc.")
+    parser.add_argument('-co', '--creation-option', dest='creation_options', action='append', default=[],
+                        help='GTiff creation option, e.g. COMPRESS=DEFLATE, PREDICTOR=3 or TILED=YES. '
+                             'Can be repeated.')
+    parser.add_argument('--max-memory', type=float, default=None,
+                        help='Approximate memory limit in megabytes of the read radiance cube chunks. '
+                             'The radiance cube is read and processed in band chunks.')
+    parser.add_argument('--write-queue', type=int, default=0,
+                        help='Write the output files in a background thread with a queue of the given size.')
+    parser.add_argument('--input-dir', default=None,
+                        help='Directory of the input *.nc files. Defaults to data/input.')
+    parser.add_argument('--output-dir', default=None,
+                        help='Directory of the output files. Defaults to data/output.')
+    parser.add_argument('--watch', type=float, default=None, metavar='INTERVAL',
+                        help='Keep running and process new input files as they land in the input directory, '
+                             'polling it every INTERVAL seconds. Stop with Ctrl+C.')
+    parser.add_argument('--metrics', default=None,
+                        help='Append the duration and processed bytes of every processing stage per input file, '
+                             'city and band chunk to the given *.csv or *.jsonl file.')
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'], default=None,
+                        help="'cprofile' profiles the function calls, 'tracemalloc' the memory allocations of "
+                             "the run. Only the main process is profiled, use with --workers 1.")
+    parser.add_argument('--manifest', default=None,
+                        help='Path to the JSON lines manifest of the processed input files. '
+                             'Defaults to manifest.jsonl in the output directory.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the input files recorded as done in the manifest for the current cities list '
+                             'and the cities whose GeoTIFF file already exists.')
+    return parser.parse_args()
+
+
+def watch_input_dir(input_dir, interval, sort_key=get_filepath_sort_key):
+    """
+    Polls the input directory for new input files. A file is yielded once its size and modification
+    time are the same in two consecutive polls, so files still being copied are not read. Files with
+    unknown names, e.g. partial downloads, are ignored. A file removed from the directory and added
+    again is yielded again. None is yielded after every poll, so the caller can handle finished files
+    while waiting for new ones.
+
+    :param input_dir: Path to the watched directory.
+    :param interval: Polling interval in seconds.
+    :param sort_key: Sort key of the files landed since the last poll, see get_filepath_sort_key.
+    :return: Generator of paths to the new input files.
+    """
+
+    stats = {}
+    seen = set()
+
+    while True:
+        landed = []
+        present = set()
+        for entry in os.scandir(input_dir):
+            if parse_filename(entry.name) is None:
+                continue
+            present.add(entry.path)
+            if entry.path in seen:
+                continue
+
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # Removed since the directory was listed
+                continue
+
+            if stats.get(entry.path) == (stat.st_size, stat.st_mtime_ns):
+                del stats[entry.path]
+                seen.add(entry.path)
+                landed.append(entry.path)
+            else:
+                stats[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+        # Files removed from the directory are forgotten, so the state stays as small as the directory
+        seen &= present
+        stats = {path: stat for path, stat in stats.items() if path in present}
+
+        for filepath in sorted(landed, key=sort_key):
+            yield filepath
+
+        yield None
+        time.sleep(interval)
+
+
+def filter_by_footprint(filepaths, cities_index):
+    """
+    Skips the input files whose footprint does not intersect any city. Only the footprint metadata of
+    the files is read, see get_file_extent. Files with unknown names or unreadable footprints are passed
+    on, so process_file reports them.
+
+    :param filepaths: Iterable of paths to the input files, None items are passed on.
+    :param cities_index: Spatial index created by build_cities_index.
+    :return: Generator of paths to the input files.
+    """
+
+    for filepath in filepaths:
+        if filepath is None or parse_filename(filepath) is None:
+            yield filepath
+            continue
+
+        try:
+            cities_in_file = query_cities_index(cities_index, get_file_extent(filepath))
+        except Exception:
+            # E.g. a damaged file or a missing footprint, process_file records the error
+            yield filepath
+            continue
+
+        if cities_in_file:
+            yield filepath
+        else:
+            print('No cities in file:', os.path.basename(filepath))
+
+
+def process_files(filepaths, cities_filename, output_dir, options, workers, manifest, start, metrics_filename=None):
+    """
+    Processes the input files and records the results in the manifest. With more than one worker the
+    files are processed by a process pool. At most 2 * workers files are submitted at a time, so a
+    watched directory is read only as fast as the workers process the files.
+
+    :param filepaths: Iterable of paths to the input files. None items are skipped, see watch_input_dir.
+    :param cities_filename: Path to the city areas catalog or GeoJSON file, see load_cities_index.
+    :param output_dir: Path to the output directory.
+    :param options: Dictionary of processing options, see DEFAULT_OPTIONS.
+    :param workers: Number of worker processes.
+    :param manifest: Manifest recording the processed files.
+    :param start: Start time of the whole run.
+    :param metrics_filename: Optional path to the metrics file the stage records are appended to, see
+        metrics.write_metrics.
+    :return: None
+    """
+
+    def report(filepath, result):
+        try:
+            manifest.record(filepath, result)
+        except OSError as e:
+            # E.g. the input file was removed in the meantime
+            result['errors'].append('Recording in the manifest failed: ' + str(e))
+        if metrics_filename:
+            metrics.write_metrics(metrics_filename, result['file'], result['stages'])
+        print_result(result, start)
+
+    if workers <= 1:
+        init_worker(cities_filename)
+
+        for filepath in filepaths:
+            if filepath is not None:
+                try:
+                    result = process_file_in_worker(filepath, output_dir, options)
+                except Exception as e:
+                    result = get_error_result(filepath, e)
+                report(filepath, result)
+        return
+
+    pending = {}
+
+    def finish(future):
+        filepath = pending.pop(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            result = get_error_result(filepath, e)
+        report(filepath, result)
+
+    def create_executor():
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cities_filename,))
+
+    executor = create_executor()
+    try:
+        for filepath in filepaths:
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            else:
+                done = [future for future in pending if future.done()]
+            for future in done:
+                finish(future)
+
+            if filepath is not None:
+                try:
+                    future = executor.submit(process_file_in_worker, filepath, output_dir, options)
+                except BrokenProcessPool:
+                    # A crashed worker, e.g. killed when out of memory, breaks the whole pool. Its pending
+                    # files are reported as failed and a new pool takes the next files.
+                    executor.shutdown(wait=False)
+                    executor = create_executor()
+                    future = executor.submit(process_file_in_worker, filepath, output_dir, options)
+                pending[future] = filepath
+
+        for future in as_completed(list(pending)):
+            finish(future)
+    finally:
+        executor.shutdown()
 
 
 def main():
+    args = parse_arguments()
     start = time.time()
 
     # Use if images are in the 'CURRENT_DIR/data/' directory
@@ -269,191 +1856,55 @@ def main():
     current_dir = 'D:\\'
 
     # CURRENT_DIR/data/input/ <- put the input *.nc files here
-    input_dir = os.path.join(current_dir, 'data', 'input')
+    input_dir = args.input_dir or os.path.join(current_dir, 'data', 'input')
 
     # CURRENT_DIR/data/output/ <- output files are saved here
-    output_dir = os.path.join(current_dir, 'data', 'output')
+    output_dir = args.output_dir or os.path.join(current_dir, 'data', 'output')
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    filepaths = [os.path.join(input_dir, file) for file in os.listdir(input_dir)]
+    cities_filename = get_cities_filename()
+    manifest = Manifest(args.manifest or os.path.join(output_dir, 'manifest.jsonl'), get_file_hash(cities_filename))
+
+    options = {
+        'threads': args.threads,
+        'resampling': args.resampling,
+        'output_format': args.output_format,
+        'creation_options': args.creation_options,
+        'write_queue': args.write_queue,
+        'max_memory': args.max_memory,
+        'skip_existing': args.resume,
+    }
 
-    with open('cities_areas.json', encoding='utf-8') as f:
-        cities_list = json.load(f)
+    # The products of an orbit are processed one after another, so they can reuse the grid neighbours
+    def sort_key(filepath):
+        return get_filepath_sort_key(filepath, args.resampling == 'swath')
 
-    for filepath in filepaths:
-        file = str(filepath.split('\\')[-1])
-        input_file_attributes = file.split('_')
-        output_file_attributes = {}
-
-        ds = nC.Dataset(filepath, 'r')
-        satellite_product_extent = get_product_extent(ds)
-
-        if input_file_attributes[2] == 'L2':
-            ds = ds['/PRODUCT']
-
-            output_file_attributes['platform'] = input_file_attributes[0]
-            output_file_attributes['level'] = input_file_attributes[2]
-            output_file_attributes['product_type'] = input_file_attributes[4]
-            output_file_attributes['sensing_date'] = input_file_attributes[7]
-
-            lats = ds.variables['latitude'][0, :, :]
-            lons = ds.variables['longitude'][0, :, :]
-            for city in cities_list['features']:
-                if output_file_attributes['product_type'] == 'CLOUD':
-                    vals = np.ma.copy(ds.variables['cloud_optical_thickness'][0, :, :])
-                    output_file_attributes['sensing_date'] = input_file_attributes[7]
-                elif output_file_attributes['product_type'] == 'SO2':
-                    vals = ds.variables['sulfurdioxide_total_vertical_column'][0, :, :]
-                    output_file_attributes['sensing_date'] = input_file_attributes[9]
-                elif output_file_attributes['product_type'] == 'O3':
-                    vals = np.ma.copy(ds.variables['ozone_total_vertical_column'][0, :, :])
-                    output_file_attributes['sensing_date'] = input_file_attributes[10]
-                else:
-                    vals = None
-
-                requested_small_bbox = get_polygon_extent(city['geometry']['coordinates'][0])
-                requested_big_bbox = requested_small_bbox.copy()
-
-                requested_big_bbox['min_lat'] -= 0.5
-                requested_big_bbox['max_lat'] += 0.5
-                requested_big_bbox['min_lon'] -= 0.5
-                requested_big_bbox['max_lon'] += 0.5
-
-                city_geojson = {
-                    'type': 'Polygon',
-                    'coordinates':
-                        city['geometry']['coordinates']
-                }
-                city_geojson = json.dumps(city_geojson)
-
-                city_extent = ogr.CreateGeometryFromJson(city_geojson)
-                intersection = satellite_product_extent.Intersection(city_extent)
-
-                if intersection.IsEmpty():
-                    pass
-                else:
-                    output_file_attributes['city_country_code'] = city['properties']['country']
-                    output_file_attributes['city_name'] = city['properties']['name-ASCII']
-
-                    output_filename = str(output_file_attributes['city_country_code']) \
-                        + '_' + str(output_file_attributes['city_name']) \
-                        + '_' + str(output_file_attributes['platform']) \
-                        + '_' + str(output_file_attributes['product_type']) \
-                        + '_' + str(output_file_attributes['sensing_date'])
-
-                    print(output_filename)
-
-                    if not os.path.exists(os.path.join(output_dir, output_file_attributes['product_type'])):
-                        os.makedirs(os.path.join(output_dir, output_file_attributes['product_type']))
-
-                    output_filename = os.path.join(output_dir, output_file_attributes['product_type'], output_filename)
-
-                    slats, slons, svals = select_points(lats, lons, vals, requested_big_bbox)
-
-                    if svals is not None:
-                        slats, slons, svals = regrid(slats, slons, svals, 100)
-                        slats, slons, svals = select_points(slats, slons, svals, requested_small_bbox)
-
-                    if svals is not None:
-                        slats, slons, svals = regrid(slats, slons, svals, 30)
-
-                        # write_csv(slats, slons, svals, output_filename)
-                        write_geotiff(svals, output_filename, requested_small_bbox)
-                        # write_png(svals, output_filename)
-
-        elif input_file_attributes[2] == 'L1B':
-            output_file_attributes['platform'] = input_file_attributes[0]
-            output_file_attributes['level'] = input_file_attributes[2]
-            output_file_attributes['product_type'] = input_file_attributes[4]
-            output_file_attributes['sensing_date'] = input_file_attributes[10][:-3]
-
-            if output_file_attributes['product_type'] == 'BD1':
-                ds_obs = ds['/BAND1_RADIANCE/STANDARD_MODE/OBSERVATIONS']
-                ds_geo = ds['/BAND1_RADIANCE/STANDARD_MODE/GEODATA']
-            else:
-                ds_obs = ds['/BAND2_RADIANCE/STANDARD_MODE/OBSERVATIONS']
-                ds_geo = ds['/BAND2_RADIANCE/STANDARD_MODE/GEODATA']
+    if args.watch:
+        print('Watching', input_dir)
+        filepaths = watch_input_dir(input_dir, args.watch, sort_key)
+        if args.resume:
+            filepaths = (filepath for filepath in filepaths if filepath is None or not manifest.is_done(filepath))
+    else:
+        filepaths = sorted((os.path.join(input_dir, file) for file in os.listdir(input_dir)), key=sort_key)
+        if args.resume:
+            skipped = [filepath for filepath in filepaths if manifest.is_done(filepath)]
+            filepaths = [filepath for filepath in filepaths if filepath not in skipped]
+            print('Skipped files:', len(skipped))
 
-            try:
-                bands = ds_obs.variables['radiance'][0, :, :, :]
-            except RuntimeError:
-                pass
-            else:
-                cities_in_file = []
-                for city in cities_list['features']:
-                    city_geojson = {
-                        'type': 'Polygon',
-                        'coordinates':
-                            city['geometry']['coordinates']
-                    }
-                    city_geojson = json.dumps(city_geojson)
-
-                    city_extent = ogr.CreateGeometryFromJson(city_geojson)
-                    intersection = satellite_product_extent.Intersection(city_extent)
-
-                    if intersection.IsEmpty():
-                        pass
-                    else:
-                        cities_in_file.append(city)
-
-                lats = ds_geo.variables['latitude'][0, :, :]
-                lons = ds_geo.variables['longitude'][0, :, :]
-                for band in range(bands.shape[2]):
-                    output_file_attributes['band'] = band
-
-                    for city in cities_in_file:
-                        vals = bands[:, :, band]
-
-                        requested_small_bbox = get_polygon_extent(city['geometry']['coordinates'][0])
-                        requested_big_bbox = requested_small_bbox.copy()
-
-                        requested_big_bbox['min_lat'] -= 0.5
-                        requested_big_bbox['max_lat'] += 0.5
-                        requested_big_bbox['min_lon'] -= 0.5
-                        requested_big_bbox['max_lon'] += 0.5
-
-                        output_file_attributes['city_country_code'] = city['properties']['country']
-                        output_file_attributes['city_name'] = city['properties']['name-ASCII']
-
-                        output_filename = str(output_file_attributes['city_country_code']) \
-                            + '_' + str(output_file_attributes['city_name']) \
-                            + '_' + str(output_file_attributes['platform']) \
-                            + '_' + str(output_file_attributes['product_type']) \
-                            + '_' + str(output_file_attributes['sensing_date']) \
-                            + '_' + str(output_file_attributes['band'])
-
-                        print(output_filename)
-
-                        if not os.path.exists(os.path.join(output_dir, output_file_attributes['product_type'])):
-                            os.makedirs(os.path.join(output_dir, output_file_attributes['product_type']))
-
-                        output_filename = os.path.join(output_dir,
-                                                       output_file_attributes['product_type'],
-                                                       output_filename)
-
-                        slats, slons, svals = select_points(lats, lons, vals, requested_big_bbox)
-
-                        if svals is not None:
-                            slats, slons, svals = regrid(slats, slons, svals, 100)
-                            slats, slons, svals = select_points(slats, slons, svals, requested_small_bbox)
-
-                        if svals is not None:
-                            slats, slons, svals = regrid(slats, slons, svals, 30)
-
-                            # write_csv(slats, slons, svals, output_filename)
-                            write_geotiff(svals, output_filename, requested_small_bbox)
-                            # write_png(svals, output_filename)
-
-                    partial_elapsed = (time.time() - start)
-                    print('Band:', band)
-                    print('Partial elapsed time:', str(timedelta(seconds=partial_elapsed)))
-                    # print('\033[92mPartial elapsed time:\033[0m', str(timedelta(seconds=partial_elapsed)))
-
-        partial_elapsed = (time.time() - start)
-        print('File:', file)
-        print('Partial elapsed time:', str(timedelta(seconds=partial_elapsed)))
-        # print('\033[92mPartial elapsed time:\033[0m', str(timedelta(seconds=partial_elapsed)))
+    filepaths = filter_by_footprint(filepaths, load_cities_index(cities_filename))
+
+    if args.profile:
+        profiler = metrics.start_profiler(args.profile)
+
+    try:
+        process_files(filepaths, cities_filename, output_dir, options, args.workers, manifest, start, args.metrics)
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+
+    if args.profile:
+        metrics.stop_profiler(args.profile, profiler, output_dir)
 
     total_elapsed = (time.time() - start)
     print('Elapsed time:', str(timedelta(seconds=total_elapsed)))
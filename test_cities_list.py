@@ -0,0 +1,77 @@
+import copy
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osr')
+geopy_distance = pytest.importorskip('geopy.distance')
+
+import cities_list
+
+BREAKS = [
+    (500000, 50.0),
+    (100000, 30.0),
+    (50000, 50.0),
+]
+
+
+def aggregate_cities_geopy(break_values, cities):
+    """
+    The geopy implementation of cities_list.aggregate_cities replaced by the KD-tree, without the
+    printing.
+    """
+
+    cities.sort(key=lambda tup: tup[3], reverse=True)
+
+    for break_value in break_values:
+        for bigger_city in cities:
+            if bigger_city[3] > break_value[0]:
+                bigger_city_coordinates = (bigger_city[4], bigger_city[5])
+                bigger_city_name = bigger_city[1]
+                cities_copy = copy.copy(cities)
+
+                for city in cities_copy:
+                    city_coordinates = (city[4], city[5])
+                    city_name = city[1]
+                    distance = geopy_distance.geodesic(bigger_city_coordinates, city_coordinates).km
+
+                    if distance < break_value[1] and city_name != bigger_city_name:
+                        cities.remove(city)
+
+    return cities
+
+
+def get_clustered_cities(seed, clusters=12, size=10):
+    """
+    Creates cities in clusters a few tens of kilometers wide, so that the break distances suppress part of
+    every cluster. Some cities share a name with a city of another cluster.
+
+    :param seed: Seed of the random generator.
+    :param clusters: Number of clusters.
+    :param size: Number of cities of a cluster.
+    :return: List of cities in cities_list.aggregate_cities format.
+    """
+
+    rng = np.random.default_rng(seed)
+    cities = []
+    for cluster in range(clusters):
+        latitude = rng.uniform(35.0, 70.0)
+        longitude = rng.uniform(-10.0, 40.0)
+        for i in range(size):
+            name = 'City {}'.format(rng.integers(0, 8) if i == 0 else '{}-{}'.format(cluster, i))
+            population = int(rng.integers(20000, 2000000))
+            cities.append(('XX', name, name, population,
+                           latitude + rng.normal(0.0, 0.4), longitude + rng.normal(0.0, 0.6)))
+    return cities
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_aggregate_cities_matches_geopy(seed, capsys):
+    cities = get_clustered_cities(seed)
+
+    expected = aggregate_cities_geopy(BREAKS, list(cities))
+    result = cities_list.aggregate_cities(BREAKS, list(cities))
+
+    assert len(expected) < len(cities)
+    assert result == expected
+
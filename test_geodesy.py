@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+geopy_distance = pytest.importorskip('geopy.distance')
+
+from geodesy import haversine_distances, vincenty_distances
+
+
+def test_distances_match_geopy():
+    rng = np.random.default_rng(3)
+    point = (52.5, 13.4)
+    points = np.column_stack((rng.uniform(-80.0, 80.0, 200), rng.uniform(-180.0, 180.0, 200)))
+
+    geodesic = np.array([geopy_distance.geodesic(point, p).km for p in points])
+    great_circle = np.array([geopy_distance.great_circle(point, p).km for p in points])
+
+    np.testing.assert_allclose(vincenty_distances(point, points), geodesic, rtol=0.0, atol=1e-6)
+    # geopy rounds the mean Earth radius to 6371.009 km
+    np.testing.assert_allclose(haversine_distances(point, points), great_circle, rtol=1e-7)
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+import run
+
+
+def float32_bits(*bits):
+    """
+    Creates a float32 array from the IEEE 754 bit patterns.
+
+    :param bits: 32-bit integers.
+    :return: float32 array.
+    """
+
+    return np.array(bits, dtype=np.uint32).view(np.float32)
+
+
+# Bit patterns which must survive the PNG round-trip unchanged
+SPECIAL_VALUES = float32_bits(
+    0x7fc00000,  # NaN
+    0x7fc12345,  # NaN with a payload
+    0xffc00001,  # negative NaN with a payload
+    0x7f800001,  # signalling NaN
+    0x7f800000,  # +inf
+    0xff800000,  # -inf
+    0x80000000,  # -0.0
+    0x00000001,  # smallest denormal
+    0x807fffff,  # largest negative denormal
+    0x7f7fffff,  # largest float32
+    0x3f800000,  # 1.0
+)
+
+
+def round_trip(values, tmp_path):
+    filename = os.path.join(str(tmp_path), 'tile')
+    run.write_png(values, filename)
+    return run.read_png(filename)
+
+
+def test_png_round_trip_special_values(tmp_path):
+    values = np.resize(SPECIAL_VALUES, (7, 5))
+
+    recovered = round_trip(values, tmp_path)
+
+    assert recovered.dtype == np.float32
+    assert recovered.shape == values.shape
+    np.testing.assert_array_equal(recovered.view(np.uint32), values.view(np.uint32))
+
+
+def test_png_round_trip_masked_cells(tmp_path):
+    values = np.ma.masked_array(np.resize(SPECIAL_VALUES, (4, 6)))
+    values[1, 2] = np.ma.masked
+    values[3, :] = np.ma.masked
+
+    recovered = round_trip(values, tmp_path)
+
+    expected = np.ma.filled(values, np.float32(np.nan))
+    np.testing.assert_array_equal(recovered.view(np.uint32), expected.view(np.uint32))
+    assert np.isnan(recovered[1, 2]) and np.isnan(recovered[3]).all()
+
+
+@pytest.mark.parametrize('layout', ['fortran', 'strided', 'big-endian'])
+def test_png_round_trip_non_contiguous(tmp_path, layout):
+    rng = np.random.default_rng(0)
+    values = rng.random((30, 30), dtype=np.float32)
+    values[::7, ::5] = SPECIAL_VALUES[0]
+
+    if layout == 'fortran':
+        # The layout of the arrays returned by regrid
+        values = np.asfortranarray(values)
+    elif layout == 'strided':
+        values = values[::2, 1::3]
+    else:
+        values = values.astype('>f4')
+
+    recovered = round_trip(values, tmp_path)
+
+    np.testing.assert_array_equal(recovered.view(np.uint32), values.astype(np.float32).view(np.uint32))
+
+
+def test_png_round_trip_regrid_output(tmp_path):
+    rng = np.random.default_rng(1)
+    latitudes, longitudes = np.meshgrid(np.linspace(50.0, 51.0, 40), np.linspace(14.0, 15.0, 40), indexing='ij')
+    values = np.ma.masked_array(rng.random((40, 40), dtype=np.float32), mask=rng.random((40, 40)) < 0.1)
+
+    values = run.regrid(latitudes, longitudes, values, 30)[2]
+
+    recovered = round_trip(values, tmp_path)
+
+    expected = np.ma.filled(values, np.float32(np.nan))
+    np.testing.assert_array_equal(recovered.view(np.uint32), expected.view(np.uint32))